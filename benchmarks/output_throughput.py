@@ -0,0 +1,108 @@
+"""Benchmark copying captured output of an external command.
+
+Runs a child process which prints many short lines, such as a beet-* script
+listing paths, and copies its output into an in-memory text stream, as is
+done when output is captured, with a range of output buffer sizes. For
+comparison, it also copies the output a line at a time, flushing after each
+line, as was done before output was buffered.
+
+Usage: python benchmarks/output_throughput.py [LINES]
+"""
+
+import asyncio
+import io
+import os
+import subprocess
+import sys
+import time
+from typing import List
+
+from beetsplug.alias import OUTPUT_FLUSH_INTERVAL
+from beetsplug.alias import run_process
+
+
+SCRIPT = """
+import sys
+write = sys.stdout.write
+for i in range(int(sys.argv[1])):
+    write(f"/music/Artist {i % 1000}/Album {i % 100}/{i:02d} Track.flac\\n")
+"""
+
+
+class CountingStream(io.TextIOBase):
+    """A text stream which counts writes, and writes to /dev/null on flush.
+
+    It has no file descriptor, so output to it must be copied through the
+    beets process, as is the case when output is captured.
+    """
+
+    def __init__(self) -> None:
+        self.writes = 0
+        self.chars = 0
+        self.pending: List[str] = []
+        self.fd = os.open(os.devnull, os.O_WRONLY)
+
+    def write(self, s: str) -> int:
+        """Count a write."""
+        self.writes += 1
+        self.chars += len(s)
+        self.pending.append(s)
+        return len(s)
+
+    def flush(self) -> None:
+        """Write the pending output to /dev/null."""
+        if self.pending:
+            os.write(self.fd, "".join(self.pending).encode())
+            self.pending.clear()
+
+
+def report(name: str, stream: CountingStream, elapsed: float) -> None:
+    """Print the results of a benchmark run."""
+    mbytes = stream.chars / 1024 / 1024
+    print(
+        f"{name:>16}: {elapsed:6.3f}s, {mbytes / elapsed:6.1f} MiB/s, "
+        f"{stream.writes:>8} writes"
+    )
+
+
+def run_per_line(lines: int) -> None:
+    """Copy the output a line at a time, flushing after every line."""
+    stream = CountingStream()
+    command = [sys.executable, "-c", SCRIPT, str(lines)]
+    start = time.perf_counter()
+    with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as p:  # noqa: S603
+        assert p.stdout is not None  # noqa: S101
+        for line in p.stdout:
+            stream.write(line)
+            stream.flush()
+    report("per line", stream, time.perf_counter() - start)
+
+
+def run_buffered(lines: int, buffer_size: int) -> None:
+    """Copy the output with run_process and the given buffer size."""
+    stream = CountingStream()
+    command = [sys.executable, "-c", SCRIPT, str(lines)]
+    start = time.perf_counter()
+    returncode = asyncio.run(
+        run_process(
+            command,
+            stdout=stream,
+            buffer_size=buffer_size,
+            flush_interval=OUTPUT_FLUSH_INTERVAL,
+        )
+    )
+    assert returncode == 0  # noqa: S101
+    report(f"buffer {buffer_size}", stream, time.perf_counter() - start)
+
+
+def main() -> None:
+    """Run the benchmark."""
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    print(f"{lines} lines")
+    run_per_line(lines)
+    for buffer_size in (4096, 64 * 1024, 1024 * 1024):
+        run_buffered(lines, buffer_size)
+
+
+if __name__ == "__main__":
+    main()
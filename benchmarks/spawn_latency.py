@@ -0,0 +1,60 @@
+"""Benchmark the latency of launching an external command.
+
+Compares launching a trivial command with fork and exec, as subprocess does by
+default, with the posix_spawn fast path used with fast_spawn enabled, while
+the parent process holds increasing amounts of memory, as a beets process
+with a large library and many plugins loaded does.
+
+Usage: python benchmarks/spawn_latency.py [RUNS]
+"""
+
+import asyncio
+import shutil
+import sys
+import time
+from typing import Any
+from typing import Dict
+
+from beetsplug.alias import run_process
+
+
+MIB = 1024 * 1024
+PAGE_SIZE = 4096
+
+
+def launch(runs: int, **kwargs: Any) -> float:
+    """Return the mean time taken to run `true`, in milliseconds."""
+    start = time.perf_counter()
+    for _ in range(runs):
+        returncode = asyncio.run(run_process(["true"], **kwargs))
+        assert returncode == 0  # noqa: S101
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def main() -> None:
+    """Run the benchmark."""
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    executable = shutil.which("true")
+    backends: Dict[str, Dict[str, Any]] = {
+        "fork_exec": {},
+        "posix_spawn": {"executable": executable, "close_fds": False},
+    }
+
+    ballast = []
+    for rss in (0, 256, 1024):
+        while len(ballast) < rss:
+            block = bytearray(MIB)
+            # Touch every page, so the memory is resident
+            for i in range(0, MIB, PAGE_SIZE):
+                block[i] = 1
+            ballast.append(block)
+
+        results = ", ".join(
+            f"{name} {launch(runs, **kwargs):7.2f}ms"
+            for name, kwargs in backends.items()
+        )
+        print(f"{rss:>5} MiB ballast: {results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,20 @@ By default, also checks $PATH for beet-* and makes those available as well.
 Example:
     alias:
       from_path: yes # Default
+      path_cache: alias_path_cache.json # Default, relative to the config directory
+      table_cache: alias_table.cache # Default, relative to the config directory
+      path_workers: 4 # Default
+      path_timeout: 2.0 # Default, in seconds per PATH directory
+      lazy: no # Default
+      exec: no # Default
+      fast_spawn: yes # Default
+      python_scripts: subprocess # Default, or inprocess, forkserver
+      socket: alias.sock # Default, for beet alias serve
+      schedule_history: alias_schedule_history.jsonl # Default
+      cache_dir: alias_cache # Default, relative to the config directory
+      cache_size: 67108864 # Default, in bytes
+      output_buffer_size: 65536 # Default, in bytes
+      output_flush_interval: 0.1 # Default, in seconds
       aliases:
         singletons: ls singleton:true
         external-cmd-test: '!echo'
@@ -12,32 +26,164 @@ Example:
         with-help-text:
           command: ls -a
           help: do something or other
+        picard:
+          command: '!picard'
+          exec: yes
 """
 # mypy: ignore-errors
 
-import glob
+import asyncio
+import codecs
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
+import datetime
+import hashlib
+import importlib.machinery
+import io
+import itertools
+import json
+import locale
+import marshal
+import multiprocessing
 import optparse
 import os
+import pkgutil
+import queue
+import random
+import re
+import runpy
+import selectors
 import shlex
+import shutil
+import socket
+import socketserver
+import sqlite3
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import traceback
 from collections import abc
-from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import reduction
 from typing import List
 from typing import Optional
 from typing import Tuple
 
 import confuse
 from beets import config
+from beets import library
 from beets import plugins
 from beets import ui
+from beets.dbcore.query import AndQuery
+from beets.dbcore.query import FixedFieldSort
+from beets.dbcore.query import InvalidQueryError
+from beets.dbcore.query import NumericQuery
 from beets.plugins import BeetsPlugin
 from beets.ui import Subcommand
 from beets.ui import print_
 from beets.ui.commands import default_commands
+from beets.util import HumanReadableException
+from beets.util import functemplate
 
 
 EXIT_STATUS_DATABASE_CHANGED = 8
+PATH_CACHE_VERSION = 1
+ALIAS_TABLE_VERSION = 1
+OUTPUT_READ_SIZE = 64 * 1024
+OUTPUT_BUFFER_SIZE = 64 * 1024
+OUTPUT_FLUSH_INTERVAL = 0.1
+PYTHON_SCRIPT_MODES = ["subprocess", "inprocess", "forkserver"]
+PYTHON_SCRIPT_HEAD_SIZE = 1024
+PIPELINE_SEPARATOR = "|"
+FEED_FORMATS = ["json", "binary"]
+FEED_CHUNK_SIZE = 1000
+FEED_FD_ENV = "BEETS_ALIAS_FEED_FD"
+FEED_NULL_LENGTH = 0xFFFFFFFF
+CHANGES_ENV = "BEETS_ALIAS_CHANGES"
+CACHE_VERSION = 1
+CACHE_SIZE = 64 * 1024 * 1024
+
+# Index of beets subcommands by name and alias, built on first use
+_command_index = None
+
+# Multiprocessing context for the forkserver, set up on first use
+_forkserver_context = None
+
+# ChangeReport for the commands of the alias being run
+_change_report = contextvars.ContextVar("change_report", default=None)
+
+# Whether this thread is running a command line for a beets process which
+# carries on afterwards, such as beet alias batch, which exec must not replace
+_resident = contextvars.ContextVar("resident", default=False)
+
+# The configuration sources added by the command line this thread is running
+_config_changes = contextvars.ContextVar("config_changes", default=None)
+
+# Held while replacing or removing configuration sources
+_config_lock = threading.Lock()
+
+# Number of database_change events sent in this process
+_library_generation = 0
+
+
+def get_app_filename(view):
+    """Return the filename set by a config view, or None if it is disabled.
+
+    A relative filename is relative to the beets configuration directory.
+    """
+    if not view.get():
+        return None
+    return view.get(confuse.Filename(in_app_dir=True))
+
+
+def get_config_paths():
+    """Return the paths of the configuration files beets has read."""
+    return [
+        source.filename
+        for source in config.sources
+        if isinstance(source, confuse.YamlSource)
+    ]
+
+
+def stat_paths(paths):
+    """Return the modification time, identity and size of each of paths."""
+    key = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            key.append(None)
+        else:
+            key.append([st.st_mtime_ns, st.st_ino, st.st_dev, st.st_size])
+    return key
+
+
+def get_command_index():
+    """Return a dict mapping command names and aliases to beets subcommands.
+
+    As with beets' own dispatch, the first command registered for a name
+    wins, and default commands take precedence over plugin commands. The
+    index is built once and reused until plugins are loaded again.
+    """
+    global _command_index
+    if _command_index is None:
+        index = {}
+        for subcommand in itertools.chain(default_commands, plugins.commands()):
+            index.setdefault(subcommand.name, subcommand)
+            for alias in subcommand.aliases:
+                index.setdefault(alias, subcommand)
+        _command_index = index
+    return _command_index
+
+
+def invalidate_command_index():
+    """Discard the command index, so it is rebuilt on next use."""
+    global _command_index
+    _command_index = None
 
 
 class NoOpOptionParser(optparse.OptionParser):
@@ -65,98 +211,982 @@ class AliasPlugin(BeetsPlugin):
         self.config.add(
             {
                 "from_path": True,
+                "path_cache": "alias_path_cache.json",
+                "table_cache": "alias_table.cache",
+                "path_workers": 4,
+                "path_timeout": 2.0,
+                "lazy": False,
+                "exec": False,
+                "fast_spawn": True,
+                "python_scripts": "subprocess",
+                "socket": "alias.sock",
+                "schedule_history": "alias_schedule_history.jsonl",
+                "cache_dir": "alias_cache",
+                "cache_size": CACHE_SIZE,
+                "output_buffer_size": OUTPUT_BUFFER_SIZE,
+                "output_flush_interval": OUTPUT_FLUSH_INTERVAL,
                 "aliases": {},
             }
         )
+        self._commands = None
+        self._reload_key = None
+        self._reload_lock = threading.Lock()
+        self.server = None
+        self.scheduler = None
+        self.register_listener("pluginload", self.pluginload)
+        self.register_listener("database_change", self.database_change)
+
+    def pluginload(self):
+        """Discard the memoized commands when plugins are (re)loaded."""
+        self._commands = None
+        invalidate_command_index()
+
+    def database_change(self, lib, model):
+        """Note that the library has changed, invalidating cached output."""
+        global _library_generation
+        _library_generation += 1
 
     def getenv(self, name, default):
         """Get the value of an environment variable."""
         return os.getenv(name, default)
 
-    def get_alias_subcommand(self, alias, command, help=None, aliases=None):
-        """Create a Subcommand instance for the specified alias."""
+    def get_alias_subcommand(
+        self, alias, command, help=None, aliases=None, options=None, lazy=False
+    ):
+        """Create a Subcommand instance for the specified alias.
+
+        options holds any further settings from the alias's expanded form. If
+        lazy is set, return a LazyAliasCommand which defers creating the real
+        subcommand until it is invoked.
+        """
+        if lazy:
+            return LazyAliasCommand(
+                alias,
+                command,
+                lambda: self.get_alias_subcommand(
+                    alias, command, help, aliases, options
+                ),
+                help=help,
+                aliases=aliases,
+            )
+
         if aliases is None:
             aliases = []
 
-        if command.startswith("!"):
-            return ExternalCommand(
-                alias, command, log=self._log, help=help, aliases=aliases
-            )
+        if is_pipeline(command):
+            cls = PipelineCommand
+        elif command.startswith("!"):
+            cls = FanOutCommand if options and options.get("each") else ExternalCommand
         else:
-            return BeetsCommand(
-                alias, command, log=self._log, help=help, aliases=aliases
-            )
+            cls = BeetsCommand
+        return cls(
+            alias, command, log=self._log, help=help, aliases=aliases, options=options
+        )
 
-    def get_path_commands(self):
+    def get_path_commands(self, rescan=False, lazy=False):
         """Create subcommands for beet-* scripts in $PATH."""
+        for alias, path in self.find_path_commands(rescan):
+            command = os.path.basename(path)
+            yield (
+                alias,
+                self.get_alias_subcommand(
+                    alias,
+                    "!" + command,
+                    f"Run external command `{command}`",
+                    options={"path": path},
+                    lazy=lazy,
+                ),
+            )
+
+    def find_path_commands(self, rescan=False):
+        """Yield (alias, path) for each executable beet-* script in $PATH.
+
+        Where a script is in more than one directory, only the first is
+        yielded, as that is the one which is run when it is found in $PATH.
+        Directories whose mtime, inode and device are unchanged since the last
+        scan are served from the on-disk path cache, unless `rescan` is set.
+        """
+        cache_path = self.get_path_cache_path()
+        if cache_path and not rescan:
+            cache = self.read_path_cache(cache_path)
+        else:
+            cache = {}
+        updated = {}
+        seen = set()
+
+        directories = self.get_path_dirs()
+        results = DeadlineMap(
+            lambda directory: self.check_path_dir(directory, cache.get(directory)),
+            directories,
+            workers=self.config["path_workers"].get(int),
+            timeout=self.config["path_timeout"].as_number(),
+        ).run()
+        for directory in directories:
+            entry = results[directory]
+            if isinstance(entry, TimeoutError):
+                entry = cache.get(directory)
+                self._log.debug(
+                    "timed out scanning {} for commands, {}",
+                    directory,
+                    "using cached commands" if entry else "skipping",
+                )
+            elif isinstance(entry, Exception):
+                self._log.debug("unable to scan {}: {}", directory, entry)
+                entry = None
+
+            if entry is None:
+                continue
+            updated[directory] = entry
+
+            for command in entry["commands"]:
+                if command not in seen:
+                    seen.add(command)
+                    yield command[5:], os.path.join(directory, command)
+
+        if cache_path and updated != cache:
+            self.write_path_cache(cache_path, updated)
+
+    def get_path_dirs(self):
+        """Return the absolute directories in $PATH, without duplicates."""
+        directories = []
         for path in self.getenv("PATH", "").split(":"):
-            cmds = glob.glob(os.path.join(path, "beet-*"))
-            for cmd in cmds:
-                if os.access(cmd, os.X_OK):
-                    command = os.path.basename(cmd)
-                    alias = command[5:]
-                    yield (
-                        alias,
-                        self.get_alias_subcommand(
-                            alias, "!" + command, f"Run external command `{command}`"
-                        ),
-                    )
+            directory = os.path.abspath(path or os.curdir)
+            if directory not in directories:
+                directories.append(directory)
+        return directories
+
+    def check_path_dir(self, directory, entry=None):
+        """Return the up to date path cache entry for directory.
+
+        The cached entry is returned as is if the directory is unchanged.
+        Returns None if the directory does not exist.
+        """
+        try:
+            st = os.stat(directory)
+        except OSError:
+            return None
+
+        key = [st.st_mtime_ns, st.st_ino, st.st_dev]
+        if entry is not None and entry["key"] == key:
+            return entry
+        return {"key": key, "commands": self.scan_path_dir(directory)}
+
+    def scan_path_dir(self, directory):
+        """Return the names of the executable beet-* scripts in directory."""
+        commands = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if (
+                    entry.name.startswith("beet-")
+                    and entry.is_file()
+                    and os.access(entry.path, os.X_OK)
+                ):
+                    commands.append(entry.name)
+        return sorted(commands)
+
+    def get_path_cache_path(self):
+        """Return the path cache filename, or None if the cache is disabled."""
+        return self.get_app_filename("path_cache")
+
+    def get_app_filename(self, option):
+        """Return the filename set by option, or None if it is disabled.
+
+        A relative filename is relative to the beets configuration directory.
+        """
+        return get_app_filename(self.config[option])
+
+    def read_path_cache(self, cache_path):
+        """Read the path cache, returning an empty cache if it is unusable."""
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(data, dict) or data.get("version") != PATH_CACHE_VERSION:
+            return {}
+        return data.get("dirs", {})
+
+    def write_path_cache(self, cache_path, dirs):
+        """Atomically replace the path cache with the given directory entries."""
+        data = {"version": PATH_CACHE_VERSION, "dirs": dirs}
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as exc:
+            self._log.debug("unable to write path cache {}: {}", cache_path, exc)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def cmd_alias(self, lib, opts, args, commands, parser=None):
+        """Print the available alias commands, or run an alias subcommand."""
+        if args:
+            name, *args = args
+            subcommands = self.get_alias_subcommands()
+            if name not in subcommands:
+                raise ui.UserError(f"unknown alias subcommand '{name}'")
+            subcommand = subcommands[name]
+            if parser is not None:
+                subcommand.root_parser = parser
+            suboptions, subargs = subcommand.parse_args(args)
+            return subcommand.func(lib, suboptions, subargs)
+
+        if opts.rescan:
+            commands = {a: c.command for a, c in self.get_commands(rescan=True).items()}
 
-    def cmd_alias(self, lib, opts, args, commands):
-        """Print the available alias commands."""
         for alias, command in sorted(commands.items()):
             print_(f"{alias}: {command}")
 
-    def commands(self):
-        """Add the alias commands."""
-        if self.config["from_path"].get(bool):
-            commands = dict(self.get_path_commands())
+    def get_alias_subcommands(self):
+        """Return a mapping of the subcommands of `beet alias`."""
+        batch = Subcommand(
+            "batch", help="Run commands read one per line from a file or stdin."
+        )
+        batch.parser.usage = "%prog [options] [FILE]"
+        batch.parser.add_option(
+            "-k",
+            "--keep-going",
+            action="store_true",
+            default=False,
+            help="run the remaining commands after a command fails",
+        )
+        batch.parser.add_option(
+            "--fail-fast",
+            action="store_false",
+            dest="keep_going",
+            help="stop at the first command which fails (default)",
+        )
+        batch.func = self.cmd_batch
+
+        serve = Subcommand(
+            "serve", help="Run commands sent by alias clients over a Unix socket."
+        )
+        serve.parser.add_option(
+            "-s",
+            "--socket",
+            help="path of the socket to listen on, instead of alias.socket",
+        )
+        serve.func = self.cmd_serve
+
+        scheduler = Subcommand(
+            "scheduler", help="Run aliases with a schedule when they are due."
+        )
+        scheduler.parser.add_option(
+            "-l",
+            "--list",
+            action="store_true",
+            default=False,
+            help="list the scheduled aliases and when they are next due",
+        )
+        scheduler.func = self.cmd_scheduler
+
+        run_parallel = Subcommand(
+            "run-parallel", help="Run several commands at once, grouping their output."
+        )
+        run_parallel.parser.usage = "%prog [options] COMMAND..."
+        run_parallel.parser.add_option(
+            "-j",
+            "--jobs",
+            type="int",
+            default=None,
+            help="run at most JOBS commands at once (default: all of them)",
+        )
+        run_parallel.func = self.cmd_run_parallel
+        return {
+            "batch": batch,
+            "serve": serve,
+            "scheduler": scheduler,
+            "run-parallel": run_parallel,
+        }
+
+    def cmd_batch(self, lib, opts, args):
+        """Run each command line read from a file, or stdin, in turn.
+
+        Each line is a command and its arguments, either shell-quoted or as
+        a JSON list, as they would be given to beet. The exit status and run
+        time of each command is written to stderr.
+        """
+        if len(args) > 1:
+            raise ui.UserError("batch accepts at most one file")
+
+        if not args or args[0] == "-":
+            source = contextlib.nullcontext(sys.stdin)
         else:
-            commands = {}
+            try:
+                source = open(args[0], encoding="utf-8")
+            except OSError as exc:
+                raise ui.UserError(f"cannot read {args[0]}: {exc}") from exc
 
-        for path, subview in [
-            ("alias.aliases", self.config["aliases"]),
-            ("aliases", config["aliases"]),
-        ]:
-            for alias in subview.keys():
-                if alias in commands:
-                    raise confuse.ConfigError(
-                        f"alias {alias} was specified multiple times"
-                    )
+        total = failed = 0
+        with source as lines:
+            for lineno, line in enumerate(lines, 1):
+                try:
+                    argv = parse_batch_line(line)
+                except ValueError as exc:
+                    raise ui.UserError(f"line {lineno}: {exc}") from exc
+                if not argv:
+                    continue
+
+                start = time.perf_counter()
+                status = self.run_invocation(lib, argv)
+                elapsed = time.perf_counter() - start
+                print(
+                    f"batch:{lineno}: exit {status} in {elapsed:.3f}s: "
+                    f"{shlex.join(argv)}",
+                    file=sys.stderr,
+                )
+
+                total += 1
+                if status not in (0, EXIT_STATUS_DATABASE_CHANGED):
+                    failed += 1
+                    if not opts.keep_going:
+                        break
+
+        if failed:
+            raise ui.UserError(f"{failed} of {total} batch commands failed")
+
+    def run_invocation(self, lib, argv, write_lock=None):
+        """Run a single beet command line, and return its exit status.
 
-                command = subview[alias].get()
-                if isinstance(command, str):
-                    commands[alias] = self.get_alias_subcommand(alias, command)
-                elif isinstance(command, abc.Mapping):
-                    command_text = command.get("command")
-                    if not command_text:
-                        raise confuse.ConfigError(f"{path}.{alias}.command not found")
-                    help_text = command.get("help", command_text)
-                    aliases = command.get("aliases")
-                    commands[alias] = self.get_alias_subcommand(
-                        alias, command_text, help=help_text, aliases=aliases
+        Errors which would end beets, including unexpected exceptions, are
+        reported and turned into an exit status of 1, so that the caller can
+        carry on with other commands.
+        If write_lock is given, it is held while running any command which
+        is not readonly, as decided by is_readonly. Changes any command
+        makes to the configuration, as the -f and -p options of ls do, are
+        undone afterwards, so they do not leak into later commands, which
+        share this process. External commands are always run as a child,
+        never with exec, as this process carries on.
+        """
+        name, *args = argv
+        subcommand = get_command_index().get(name)
+        token = _resident.set(True)
+        try:
+            if subcommand is None:
+                raise ui.UserError(f"unknown command '{name}'")
+            if isinstance(subcommand, LazyAliasCommand):
+                subcommand = subcommand.subcommand
+
+            if is_readonly(subcommand):
+                write_lock = None
+            with restoring_config(write_lock):
+                suboptions, subargs = subcommand.parse_args(args)
+                if isinstance(subcommand, AliasCommand):
+                    return subcommand.invoke(lib, suboptions, subargs)
+                subcommand.func(lib, suboptions, subargs)
+        except SystemExit as exc:
+            if exc.code is None or isinstance(exc.code, int):
+                return exc.code or 0
+            print(exc.code, file=sys.stderr)
+            return 1
+        except (ui.UserError, confuse.ConfigError, InvalidQueryError) as exc:
+            print(f"error: {exc}", file=sys.stderr)
+            return 1
+        except HumanReadableException as exc:
+            print(f"error: {exc.get_message()}", file=sys.stderr)
+            return 1
+        except Exception as exc:
+            self._log.debug("{}", traceback.format_exc())
+            print(f"error: {exc}", file=sys.stderr)
+            return 1
+        finally:
+            _resident.reset(token)
+        return 0
+
+    def cmd_run_parallel(self, lib, opts, args):
+        """Run several command lines at once, writing their output in turn.
+
+        Each argument is a shell-quoted command line, as for batch. Each
+        command runs in its own thread, with its own connection to the
+        library, and beets commands other than readonly aliases run one at
+        a time.
+        The output of each command is held until it and the commands before
+        it have finished, and the exit status is that of the first failure.
+        """
+        if opts.jobs is not None and opts.jobs < 1:
+            raise ui.UserError("--jobs must be positive")
+        try:
+            invocations = [parse_batch_line(arg) for arg in args]
+        except ValueError as exc:
+            raise ui.UserError(str(exc)) from exc
+        if not invocations or not all(invocations):
+            raise ui.UserError("run-parallel needs one or more commands")
+
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = ThreadLocalStream(stdout), ThreadLocalStream(stderr)
+        write_lock = threading.Lock()
+        statuses = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                opts.jobs or len(invocations)
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self.run_captured, lib, argv, write_lock, stdout, stderr
                     )
-                else:
-                    raise confuse.ConfigError(
-                        f"{path}.{alias} must be a string or single-element mapping"
+                    for argv in invocations
+                ]
+                for argv, future in zip(invocations, futures):
+                    status, elapsed, outputs = future.result()
+                    for captured, stream in zip(outputs, (stdout, stderr)):
+                        sink = OutputSink(stream)
+                        sink.write(captured.buffer.getvalue())
+                        sink.close()
+                    print(
+                        f"run-parallel: exit {status} in {elapsed:.3f}s: "
+                        f"{shlex.join(argv)}",
+                        file=stderr,
                     )
+                    statuses.append(status)
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
 
-        if "alias" in commands:
-            raise ui.UserError("alias `alias` is reserved for the alias plugin")
+        status = combine_returncodes(statuses)
+        if status:
+            plugins.send("cli_exit", lib=lib)
+            lib._close()
+            sys.exit(status)
+
+    def run_captured(self, lib, argv, write_lock, stdout, stderr):
+        """Run a command line, capturing its output.
+
+        sys.stdout and sys.stderr must be ThreadLocalStream instances. The
+        output is captured in the encoding of the stdout and stderr streams.
 
-        alias = Subcommand("alias", help="Print the available alias commands.")
+        Returns the exit status, the run time, and the captured stdout and
+        stderr streams.
+        """
+        outputs = [
+            io.TextIOWrapper(
+                io.BytesIO(),
+                encoding=getattr(stream, "encoding", None)
+                or locale.getpreferredencoding(False),
+                errors="replace",
+                write_through=True,
+            )
+            for stream in (stdout, stderr)
+        ]
+        start = time.perf_counter()
+        with sys.stdout.redirect(outputs[0]), sys.stderr.redirect(outputs[1]):
+            status = self.run_invocation(lib, argv, write_lock)
+        return status, time.perf_counter() - start, outputs
+
+    def cmd_serve(self, lib, opts, args):
+        """Run commands sent by alias clients over a Unix socket until stopped."""
+        if args:
+            raise ui.UserError("serve does not accept arguments")
+        if not hasattr(socket, "AF_UNIX"):
+            raise ui.UserError("serve requires Unix domain sockets")
+
+        path = opts.socket or self.get_app_filename("socket")
+        if os.path.exists(path):
+            try:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                raise ui.UserError(f"an alias server is already running at {path}")
+
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = ThreadLocalStream(stdout), ThreadLocalStream(stderr)
+        self._reload_key = self.get_reload_key()
+        self.server = AliasServer(path, self, lib)
+        self._log.info("serving aliases on {}", path)
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            self.server.server_close()
+            os.unlink(path)
+
+    def cmd_scheduler(self, lib, opts, args):
+        """Run scheduled aliases when they are due, until stopped."""
+        if args:
+            raise ui.UserError("scheduler does not accept arguments")
+
+        schedules = self.get_schedules()
+        if opts.list:
+            now = time.time()
+            for name, schedule in schedules.items():
+                due = time.strftime(
+                    "%Y-%m-%d %H:%M", time.localtime(schedule.next_run(now))
+                )
+                print_(f"{name}: {due}")
+            return
+        if not schedules:
+            raise ui.UserError("no aliases have a schedule")
+
+        self.scheduler = AliasScheduler(
+            self, lib, schedules, self.get_app_filename("schedule_history")
+        )
+        self._log.info("scheduling {} aliases", len(schedules))
+        try:
+            self.scheduler.run()
+        except KeyboardInterrupt:
+            self.scheduler.stop()
+        finally:
+            self.scheduler.join()
+
+    def get_schedules(self):
+        """Return a mapping of alias names to the schedules of scheduled aliases."""
+        schedules = {}
+        for command in self.commands():
+            if isinstance(command, LazyAliasCommand):
+                command = command.subcommand
+            if isinstance(command, AliasCommand) and "schedule" in command.options:
+                schedules[command.name] = AliasSchedule(
+                    command.name, command.options["schedule"]
+                )
+        return schedules
+
+    def get_reload_key(self):
+        """Return the state of the configuration files and $PATH directories."""
+        paths = get_config_paths()
+        if self.config["from_path"].get(bool):
+            paths.extend(self.get_path_dirs())
+        return paths, stat_paths(paths)
+
+    def reload_if_changed(self):
+        """Reload the configuration and aliases if their sources have changed."""
+        with self._reload_lock:
+            key = self.get_reload_key()
+            if key == self._reload_key:
+                return
+            self._log.info("configuration or $PATH changed, reloading aliases")
+            config.reload()
+            self.pluginload()
+            self._reload_key = key
+
+    def commands(self):
+        """Add the alias commands.
+
+        The commands are memoized, as beets calls this for every dispatch of
+        an internal alias, until plugins are loaded again.
+        """
+        if self._commands is None:
+            self._commands = self.build_commands()
+            try:
+                for command in self._commands:
+                    if isinstance(command, AliasCommand):
+                        self.check_command(command)
+            except Exception:
+                self._commands = None
+                raise
+        return self._commands
+
+    def check_command(self, command):
+        """Prepare an alias, to report any error early.
+
+        An invalid alias is reported, and fails when it is run, but does not
+        stop beets, or the other aliases, from working, so that the
+        configuration can still be fixed with `beet config -e`.
+        """
+        try:
+            command.prepare()
+        except (ui.UserError, confuse.ConfigError) as exc:
+            self._log.warning("{}", exc)
+
+    def build_commands(self):
+        """Create the alias commands."""
+        commands = self.get_commands()
+
+        alias = Subcommand(
+            "alias",
+            help="Print the available alias commands, or run an alias subcommand.",
+        )
+        alias.parser.usage = "%prog [options] [batch|serve|scheduler|run-parallel ...]"
+        alias.parser.disable_interspersed_args()
+        alias.parser.add_option(
+            "--rescan",
+            action="store_true",
+            default=False,
+            help="rescan $PATH for beet-* commands, ignoring the path cache",
+        )
         alias_commands = dict((a, c.command) for a, c in commands.items())
         alias.func = lambda lib, opts, args: self.cmd_alias(
-            lib, opts, args, alias_commands
+            lib, opts, args, alias_commands, alias.parser
         )
         commands["alias"] = alias
-        return commands.values()
+        return list(commands.values())
+
+    def get_alias_table(self):
+        """Return the validated alias table, from the table cache if current.
+
+        The table is served from the cache while the configuration files are
+        unchanged, skipping the walk over the aliases through confuse. It is
+        always compiled afresh if there are no aliases, or if aliases were set
+        other than by a configuration file, such as from the command line.
+        """
+        resolved = [
+            (path, list(view.resolve()))
+            for path, view in [
+                ("alias.aliases", self.config["aliases"]),
+                ("aliases", config["aliases"]),
+            ]
+        ]
+        sources = [
+            source for _, values in resolved for value, source in values if value
+        ]
+        cache_path = self.get_app_filename("table_cache")
+        if (
+            cache_path is None
+            or not sources
+            or not all(isinstance(source, confuse.YamlSource) for source in sources)
+        ):
+            return compile_alias_table(resolved)
+
+        paths = get_config_paths()
+        key = [paths, stat_paths(paths)]
+        table = self.read_alias_table(cache_path, key)
+        if table is None:
+            table = compile_alias_table(resolved)
+            self.write_alias_table(cache_path, key, table)
+        return table
+
+    def read_alias_table(self, cache_path, key):
+        """Read the cached alias table, or return None if it is not current."""
+        try:
+            with open(cache_path, "rb") as f:
+                data = marshal.load(f)  # noqa: S302
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if (
+            not isinstance(data, tuple)
+            or len(data) != 3
+            or data[0] != ALIAS_TABLE_VERSION
+            or data[1] != key
+        ):
+            return None
+        return data[2]
+
+    def write_alias_table(self, cache_path, key, table):
+        """Atomically replace the cached alias table."""
+        try:
+            data = marshal.dumps((ALIAS_TABLE_VERSION, key, table))
+        except ValueError as exc:
+            self._log.debug("unable to cache the alias table: {}", exc)
+            return
+
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, cache_path)
+        except OSError as exc:
+            self._log.debug("unable to write alias table {}: {}", cache_path, exc)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def get_commands(self, rescan=False):
+        """Return a mapping of alias names to their subcommands."""
+        lazy = self.config["lazy"].get(bool)
+        if self.config["from_path"].get(bool):
+            commands = dict(self.get_path_commands(rescan, lazy))
+        else:
+            commands = {}
+
+        for alias, command, help_text, aliases, options in self.get_alias_table():
+            if alias in commands:
+                raise confuse.ConfigError(f"alias {alias} was specified multiple times")
+            commands[alias] = self.get_alias_subcommand(
+                alias,
+                command,
+                help=help_text,
+                aliases=aliases,
+                options=options,
+                lazy=lazy,
+            )
+
+        if "alias" in commands:
+            raise ui.UserError("alias `alias` is reserved for the alias plugin")
+
+        return commands
+
+
+def compile_alias_table(resolved):
+    """Validate the alias configuration in one pass and return the aliases.
+
+    resolved holds the configuration path and the values from each source,
+    in order of priority, for the `alias.aliases` and `aliases` sections.
+    An alias is taken from the first source which sets it, as confuse would.
+    Returns a tuple of (alias, command, help, aliases, options) for each
+    alias, holding only built-in types. Raises ConfigError listing every
+    invalid alias.
+    """
+    table, seen, errors = [], set(), []
+    for path, sources in resolved:
+        section = set()
+        for value, _ in sources:
+            if not isinstance(value, abc.Mapping):
+                errors.append(f"{path} must be a dict, not {type(value).__name__}")
+                continue
+
+            for alias, command in value.items():
+                if alias in section:
+                    continue
+                section.add(alias)
+                if alias in seen:
+                    errors.append(f"alias {alias} was specified multiple times")
+                    continue
+                seen.add(alias)
+
+                try:
+                    table.append(compile_alias(path, alias, command))
+                except confuse.ConfigError as exc:
+                    errors.append(str(exc))
+
+    if errors:
+        raise confuse.ConfigError("\n".join(errors))
+    return tuple(table)
+
+
+def compile_alias(path, alias, command):
+    """Validate an alias and return its entry in the alias table."""
+    if isinstance(command, str):
+        return alias, command, None, None, None
+    if not isinstance(command, abc.Mapping):
+        raise confuse.ConfigError(
+            f"{path}.{alias} must be a string or single-element mapping"
+        )
+    if not command.get("command"):
+        raise confuse.ConfigError(f"{path}.{alias}.command not found")
+
+    options = {
+        k: to_builtin(v)
+        for k, v in command.items()
+        if k not in ("command", "help", "aliases")
+    }
+    return (
+        alias,
+        command["command"],
+        command.get("help", command["command"]),
+        to_builtin(command.get("aliases")),
+        options,
+    )
+
+
+def to_builtin(value):
+    """Return a configuration value with its mappings as plain dicts."""
+    if isinstance(value, abc.Mapping):
+        return {k: to_builtin(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [to_builtin(v) for v in value]
+    return value
+
+
+class AliasTemplate:
+    """An alias command, tokenized once so it can be expanded cheaply.
+
+    Each token is either a literal string, None for the `{}` remainder
+    placeholder, or a tuple of parts for a token containing `{X}`
+    placeholders, where each part is a literal string or an argument index.
+    labels maps argument indexes to the text left in place of a missing
+    argument, where that is not `{X}`, as in a composed template.
+    """
+
+    placeholder = re.compile(r"\{(\d+)\}")
+
+    def __init__(self, tokens, labels=None):
+        self.tokens = tokens
+        self.labels = labels or {}
+        self.indexes = frozenset(
+            part
+            for token in tokens
+            if isinstance(token, tuple)
+            for part in token
+            if isinstance(part, int)
+        )
+        self.has_remainder = None in tokens
+
+    @classmethod
+    def compile(cls, command):
+        """Tokenize command into a template.
+
+        Raises ValueError if command is not valid shell syntax.
+        """
+        tokens = []
+        for word in shlex.split(command):
+            if word == "{}":
+                tokens.append(None)
+                continue
+
+            parts = cls.placeholder.split(word)
+            if len(parts) == 1:
+                tokens.append(word)
+            else:
+                # Odd elements of the split are the captured indexes
+                tokens.append(
+                    tuple(
+                        int(part) if i % 2 else part
+                        for i, part in enumerate(parts)
+                        if part or i % 2
+                    )
+                )
+        return cls(tokens)
+
+    def expand(self, args):
+        """Return the expanded command and the arguments not substituted.
+
+        `{X}` is replaced by args[X], or left as is if there is no such
+        argument. The arguments not substituted replace `{}` if it is
+        present, and are appended otherwise.
+        """
+        rest = [arg for i, arg in enumerate(args) if i not in self.indexes]
+
+        command = []
+        for token in self.tokens:
+            if token is None:
+                command.extend(rest)
+            elif isinstance(token, str):
+                command.append(token)
+            else:
+                command.append("".join(self.fill(part, args) for part in token))
+
+        if not self.has_remainder:
+            command.extend(rest)
+        return command, rest
+
+    def fill(self, part, args):
+        """Return the text for a part of a token."""
+        if isinstance(part, str):
+            return part
+        elif part < len(args):
+            return args[part]
+        else:
+            return self.labels.get(part, f"{{{part}}}")
+
+    def compose(self, inner):
+        """Return a template for running inner with this template's expansion.
+
+        This template's first token names the alias whose template is inner,
+        and the rest of its expansion are the arguments inner is expanded
+        with. The composed template expands to the same command as that
+        second expansion, in one step. Returns None if the templates cannot
+        be composed, as the position of this template's remainder in its
+        expansion depends on the number of arguments.
+        """
+        if not self.tokens or not isinstance(self.tokens[0], str):
+            return None
+        fixed = self.tokens[1:]
+        if fixed and fixed[-1] is None:
+            fixed = fixed[:-1]
+        if None in fixed:
+            return None
+
+        # The arguments of inner are the fixed tokens of this template, then
+        # the arguments this template does not substitute, in order
+        free = (i for i in itertools.count() if i not in self.indexes)
+        mapped, taken = {}, -1
+        labels = dict(self.labels)
+        for index in sorted(i for i in inner.indexes if i >= len(fixed)):
+            while taken < index - len(fixed):
+                arg = next(free)
+                taken += 1
+            mapped[index] = arg
+            labels[arg] = inner.labels.get(index, f"{{{index}}}")
+
+        unused = [token for i, token in enumerate(fixed) if i not in inner.indexes]
+        tokens = []
+        for token in inner.tokens:
+            if token is None:
+                tokens.extend(unused)
+                tokens.append(None)
+            elif isinstance(token, str):
+                tokens.append(token)
+            else:
+                tokens.append(self.compose_token(token, fixed, mapped))
+        if not inner.has_remainder:
+            tokens.extend(unused)
+        return AliasTemplate(tokens, labels)
+
+    @staticmethod
+    def compose_token(token, fixed, mapped):
+        """Return a token of an inner template, composed as by compose."""
+        parts = []
+        for part in token:
+            if isinstance(part, str):
+                parts.append(part)
+            elif part in mapped:
+                parts.append(mapped[part])
+            elif isinstance(fixed[part], str):
+                parts.append(fixed[part])
+            else:
+                parts.extend(fixed[part])
+        if all(isinstance(part, str) for part in parts):
+            return "".join(parts)
+        return tuple(parts)
+
+
+class LazyAliasCommand(Subcommand):
+    """A lightweight stand-in for an alias subcommand.
+
+    Only the name, aliases and help needed to dispatch and list the command
+    are kept. The real subcommand, and its option parser, is created by
+    factory the first time it is needed, which is normally only for the
+    subcommand being invoked.
+    """
+
+    def __init__(self, name, command, factory, help=None, aliases=None):
+        # Subcommand.__init__ is deliberately not called, as it creates a parser
+        self.name = name
+        self.command = command
+        self.help = help or command
+        self.aliases = aliases or []
+        self.hide = False
+        self._root_parser = None
+        self._factory = factory
+        self._subcommand = None
+
+    @property
+    def subcommand(self):
+        """Return the real subcommand, creating it if needed."""
+        if self._subcommand is None:
+            self._subcommand = self._factory()
+            if self._root_parser is not None:
+                self._subcommand.root_parser = self._root_parser
+        return self._subcommand
+
+    @property
+    def parser(self):
+        """Return the option parser of the real subcommand."""
+        return self.subcommand.parser
+
+    @property
+    def root_parser(self):
+        """Return the root parser."""
+        return self._root_parser
+
+    @root_parser.setter
+    def root_parser(self, root_parser):
+        self._root_parser = root_parser
+        if self._subcommand is not None:
+            self._subcommand.root_parser = root_parser
+
+    def func(self, lib, opts, args):
+        """Run the real subcommand."""
+        return self.subcommand.func(lib, opts, args)
 
 
 class AliasCommand(Subcommand):
     """Base class for alias subcommands."""
 
-    def __init__(self, name, command, log, help=None, aliases=None):
+    # Whether the alias runs external commands, which may report the items
+    # and albums they changed
+    report_changes = False
+
+    def __init__(self, name, command, log, help=None, aliases=None, options=None):
         super().__init__(
             name,
             help=help or command,
@@ -167,49 +1197,72 @@ class AliasCommand(Subcommand):
         self.name = name
         self.log = log
         self.command = command
+        self.options = options or {}
+        self.template = None
+        self.error = None
+        try:
+            self.template = AliasTemplate.compile(command)
+            self.configure()
+        except ValueError as exc:
+            self.error = confuse.ConfigError(f"alias {name}: {exc}")
+        except confuse.ConfigError as exc:
+            self.error = exc
+
+    def configure(self):
+        """Validate the options of the alias once its template is compiled.
+
+        An error raised here is kept, and raised again when the alias is
+        prepared or run, so that an invalid alias does not stop the others
+        from loading.
+        """
+
+    def prepare(self):
+        """Raise the error found in the alias when it was loaded, if any."""
+        if self.error is not None:
+            raise self.error
 
     def substitute_parameters(self, args):
-        """Replace all occurrences of {X} in command with args[X]."""
-        command = self.command
-
-        for i, arg in reversed(list(enumerate(args))):
-            token = f"{'{'}{i}{'}'}"
-            if token in command:
-                command = command.replace(token, arg)
-                del args[i]
-
-        split_command = shlex.split(command)
-        # search for token {} and replace it with the rest of the arguments,
-        # if it exists, or append otherwise
-        if "{}" in split_command:
-            for i, arg in reversed(list(enumerate(split_command))):
-                if arg == "{}":
-                    split_command[i : i + 1] = args
-        else:
-            split_command = split_command + args
+        """Replace all occurrences of {X} in command with args[X].
 
-        return split_command
+        The arguments which were not substituted are left in args.
+        """
+        command, args[:] = self.template.expand(args)
+        return command
 
     def func(self, lib, opts, args=None):
-        """Run the command with the specified arguments."""
+        """Run the command with the specified arguments.
+
+        If an external command fails, beets exits with its exit status.
+        """
+        returncode = self.invoke(lib, opts, args)
+        if returncode:
+            plugins.send("cli_exit", lib=lib)
+            lib._close()
+            sys.exit(returncode)
+
+    def invoke(self, lib, opts, args=None):
+        """Run the command, and return the exit status of an external command."""
+        if self.error is not None:
+            self.failed(lib, self.name, [self.command], message=str(self.error))
+            raise self.error
         command = self.substitute_parameters(args)
 
         self.log.debug("Running {}", subprocess.list2cmdline(command))
 
-        try:
-            self.run_command(lib, opts, command)
-        except subprocess.CalledProcessError as exc:
-            self.failed(lib, self.name, command, exc.returncode)
-            plugins.send("cli_exit", lib=lib)
-            lib._close()
-            sys.exit(exc.returncode)
-        except SystemExit as exc:
-            if exc.code not in [None, 0]:
-                self.failed(lib, self.name, command, exc.code)
+        with self.reporting_changes() as report:
+            try:
+                self.run_command(lib, opts, command)
+            except subprocess.CalledProcessError as exc:
+                changes = report.read() if report is not None else None
+                self.failed(lib, self.name, command, exc.returncode, changes=changes)
+                return exc.returncode
+            except SystemExit as exc:
+                if exc.code not in [None, 0]:
+                    self.failed(lib, self.name, command, exc.code)
+                    raise
+            except Exception as exc:
+                self.failed(lib, self.name, command, message=str(exc))
                 raise
-        except Exception as exc:
-            self.failed(lib, self.name, command, message=str(exc))
-            raise
 
         plugins.send(
             "alias_succeeded",
@@ -218,16 +1271,40 @@ class AliasCommand(Subcommand):
             command=command,
             args=args,
         )
+        return 0
+
+    @contextlib.contextmanager
+    def reporting_changes(self):
+        """Set up a report for the alias's commands to report their changes to.
+
+        Yields the ChangeReport, which is given to the commands run in this
+        context, or None if the alias does not run external commands.
+        """
+        if not self.report_changes:
+            yield None
+            return
+
+        report = ChangeReport()
+        token = _change_report.set(report)
+        try:
+            yield report
+        finally:
+            _change_report.reset(token)
+            report.remove()
+
+    def failed(self, lib, alias, command, exitcode=None, message="", changes=None):
+        """Log the failure and send a plugin event.
 
-    def failed(self, lib, alias, command, exitcode=None, message=""):
-        """Log the failure and send a plugin event."""
+        changes holds the items and albums the command reported changing, if
+        it exited with the database changed status.
+        """
         if exitcode == EXIT_STATUS_DATABASE_CHANGED:
             self.log.debug(
                 "command `{0}` exited with {1}, triggering database change event",
                 command,
                 exitcode,
             )
-            plugins.send("database_change", lib=lib, model=None)
+            send_database_change(lib, changes)
         else:
             exitmsg = f" with {exitcode}" if exitcode else ""
             if message:
@@ -249,59 +1326,1948 @@ class AliasCommand(Subcommand):
         )
 
 
-class BeetsCommand(AliasCommand):
-    """An alias to run a beets command."""
+class ChangeReport:
+    """A file for the commands run by an alias to report their changes to.
 
-    def run_command(self, lib, opts, command):
-        """Run the beets command."""
-        cmdname = command[0]
+    The file is only created when a child process is started with it, so
+    none is left behind by a command which is run with exec, or in process.
+    """
 
-        subcommands = list(default_commands)
-        subcommands.extend(plugins.commands())
-        for subcommand in subcommands:
-            if cmdname == subcommand.name or cmdname in subcommand.aliases:
-                break
-        else:
-            raise ui.UserError(f"unknown command '{cmdname}'")
+    def __init__(self):
+        self.path = None
 
-        suboptions, subargs = subcommand.parse_args(command[1:])
+    def get_path(self):
+        """Return the path of the file, creating it if need be."""
+        if self.path is None:
+            fd, self.path = tempfile.mkstemp(prefix="beets-alias-changes-")
+            os.close(fd)
+        return self.path
 
-        return subcommand.func(lib, suboptions, subargs)
+    def read(self):
+        """Return the changes reported so far, as by read_changes."""
+        return read_changes(self.path)
 
+    def remove(self):
+        """Remove the file, if it was created."""
+        if self.path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.path)
+            self.path = None
 
-class ExternalCommand(AliasCommand):
-    """An alias to run an external command."""
 
-    def run_command(self, lib, opts, command):
-        """Run the external command."""
-        command[0] = command[0][1:]
-        return check_call_redirected(command)
+def read_changes(path):
+    """Return the changes reported to the file at path by a command.
 
+    Each line of the file is `item ID` or `album ID`. Returns a set of
+    (model, id) pairs, or None if nothing was reported or the report could
+    not be read.
+    """
+    if path is None:
+        return None
 
-def redirect_output(p, stdfile, log):
-    """Redirect data from stdfile to log while waiting for p to finish."""
-    while p.poll() is None:
-        log.write(stdfile.readline())
-        log.flush()
+    changes = set()
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                model, id = line.split()
+                if model not in ("item", "album"):
+                    return None
+                changes.add((model, int(id)))
+    except (OSError, ValueError):
+        return None
+    return changes or None
 
-    # Write the rest from the buffer
-    log.write(stdfile.read())
 
+def send_database_change(lib, changes):
+    """Send database_change events for the changes reported by a command.
 
-def check_call_redirected(*popenargs, **kwargs):
-    """Like subprocess.check_call, but redirects the output to sys.stdout/sys.stderr.
+    An event is sent for each changed item or album. If no changes were
+    reported, or some of the objects no longer exist, a single event with no
+    model is sent as well, meaning that anything may have changed.
+    """
+    unknown = not changes
+    for model, id in sorted(changes or ()):
+        obj = lib.get_album(id) if model == "album" else lib.get_item(id)
+        if obj is None:
+            unknown = True
+        else:
+            plugins.send("database_change", lib=lib, model=obj)
+    if unknown:
+        plugins.send("database_change", lib=lib, model=None)
+
+
+def get_child_env(**extra):
+    """Return the environment for an external command run by an alias.
+
+    This includes $BEETS_ALIAS_CHANGES, if the alias being run by this thread
+    takes reports of changes, and any extra variables.
+    """
+    env = dict(os.environ)
+    report = _change_report.get()
+    if report is not None:
+        env[CHANGES_ENV] = report.get_path()
+    env.update(extra)
+    return env
+
+
+class BeetsCommand(AliasCommand):
+    """An alias to run a beets command.
 
-    This is used to ensure that we can capture the output in the tests.
+    If the alias's expanded form lists `libraries`, the command is run against
+    each of those libraries at once, rather than the current library, and
+    their output is merged a line at a time as it arrives. With `cache`
+    enabled, the output of the command is kept, and replayed for the same
+    arguments until the library changes.
     """
-    with subprocess.Popen(  # noqa: S603
-        *popenargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, **kwargs
-    ) as p:
-        with ThreadPoolExecutor(2) as pool:
-            r1 = pool.submit(redirect_output, p, p.stdout, sys.stdout)
-            r2 = pool.submit(redirect_output, p, p.stderr, sys.stderr)
-            r1.result()
-            r2.result()
 
-    if p.returncode:
-        raise subprocess.CalledProcessError(p.returncode, popenargs[0])
+    def __init__(self, *args, **kwargs):
+        self.prepared = False
+        self.flattened = False
+        self.target = None
+        self.fixed = None
+        self.libraries = None
+        self.cache = False
+        super().__init__(*args, **kwargs)
+
+    def configure(self):
+        """Validate the libraries and cache options."""
+        libraries = self.options.get("libraries")
+        if isinstance(libraries, str):
+            libraries = [libraries]
+        if libraries is not None and not (
+            libraries and all(isinstance(path, str) for path in libraries)
+        ):
+            raise confuse.ConfigError(
+                f"alias {self.name}: libraries must be a list of paths"
+            )
+        self.libraries = libraries
+        self.cache = self.options.get("cache", False)
+        if not isinstance(self.cache, bool):
+            raise confuse.ConfigError(f"alias {self.name}: cache must be yes or no")
+        if self.cache and libraries:
+            raise confuse.ConfigError(
+                f"alias {self.name}: cache cannot be used with libraries"
+            )
+
+    def prepare(self):
+        """Resolve the target subcommand and parse the fixed part of the alias.
+
+        The leading arguments of the alias which contain no placeholders are
+        parsed against the target's option parser once, so that only the
+        arguments supplied by the user need to be parsed when it is run. This
+        also validates the alias against its target. An error is raised again
+        each time the alias is prepared.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.prepared:
+            return
+
+        try:
+            self.resolve_target()
+        except (ui.UserError, confuse.ConfigError) as exc:
+            self.error = exc
+            raise
+        self.prepared = True
+
+    def resolve_target(self):
+        """Resolve the target subcommand and parse the fixed arguments."""
+        self.flatten()
+        tokens = self.template.tokens
+        if tokens and isinstance(tokens[0], str):
+            target = get_command_index().get(tokens[0])
+            if target is None:
+                raise ui.UserError(f"alias {self.name}: unknown command '{tokens[0]}'")
+
+            fixed = []
+            for word in tokens[1:]:
+                if not isinstance(word, str) or word == "--":
+                    break
+                fixed.append(word)
+
+            if fixed and not has_callback_options(target.parser, fixed):
+                self.fixed = self.parse_fixed(
+                    target.parser, fixed, complete=len(fixed) == len(tokens) - 1
+                )
+            self.target = target
+
+    def flatten(self):
+        """Compose the templates of a chain of aliases into this alias's.
+
+        Where this alias runs another alias, which may run another and so on,
+        the alias gets a single template which expands straight to the
+        command at the end of the chain, so the aliases in between are not
+        run, and the cost of running it does not depend on the length of the
+        chain. The chain stops being composed at an alias with libraries or
+        cache, or whose template cannot be composed, which is run as before.
+
+        Raises ConfigError if the chain leads back to an alias in it.
+        """
+        if self.flattened:
+            return
+
+        index = get_command_index()
+        chain, template, composing = [self.name], self.template, True
+        alias = self
+        while alias.template.tokens and isinstance(alias.template.tokens[0], str):
+            target = index.get(alias.template.tokens[0])
+            if isinstance(target, LazyAliasCommand):
+                target = target.subcommand
+            if not isinstance(target, BeetsCommand) or target.error is not None:
+                break
+            if target.name in chain:
+                raise confuse.ConfigError(
+                    f"alias {self.name}: alias cycle "
+                    + " -> ".join([*chain, target.name])
+                )
+            chain.append(target.name)
+
+            if composing and not (target.libraries or target.cache):
+                composed = template.compose(target.template)
+                composing = composed is not None
+                if composing:
+                    template = composed
+                    self.log.debug(
+                        "Flattened alias {} through {}", self.name, target.name
+                    )
+            else:
+                composing = False
+            alias = target
+
+        self.template = template
+        self.flattened = True
+
+    def parse_fixed(self, parser, fixed, complete):
+        """Parse the fixed arguments of the alias.
+
+        Returns the parsed options, the positional arguments and the number of
+        fixed arguments which were parsed.
+        """
+        try:
+            values, args = parse_args_strict(parser, fixed)
+        except confuse.ConfigError as exc:
+            if complete:
+                raise confuse.ConfigError(f"alias {self.name}: {exc}") from exc
+
+            # The last option may take a placeholder as its value
+            fixed = fixed[:-1]
+            try:
+                values, args = parse_args_strict(parser, fixed)
+            except confuse.ConfigError:
+                raise confuse.ConfigError(f"alias {self.name}: {exc}") from exc
+        return values, args, len(fixed)
+
+    def substitute_parameters(self, args):
+        """Replace all occurrences of {X} in command with args[X].
+
+        Any chain of aliases is flattened first, so the arguments are
+        substituted once, for the command at the end of the chain.
+        """
+        self.flatten()
+        return super().substitute_parameters(args)
+
+    def run_command(self, lib, opts, command):
+        """Run the beets command."""
+        self.prepare()
+
+        cache, key = None, None
+        if self.cache:
+            cache = get_output_cache()
+            key = get_cache_key(lib, command)
+        if cache is not None and key is not None:
+            output = cache.get(key)
+            if output is not None:
+                self.log.debug("Replaying the cached output of {}", self.name)
+                sink = OutputSink(sys.stdout)
+                sink.write(output)
+                sink.close()
+                return None
+
+        if self.fixed is not None:
+            values, args, nfixed = self.fixed
+            subcommand = self.target
+            suboptions, subargs = subcommand.parser.parse_args(
+                command[1 + nfixed :], copy.deepcopy(values)
+            )
+            subargs = args + subargs
+        else:
+            subcommand, suboptions, subargs = parse_beets_command(command)
+
+        if self.libraries:
+            return self.run_sharded(subcommand.func, suboptions, subargs)
+        if cache is not None and key is not None:
+            return self.run_cached(
+                cache, key, lambda: subcommand.func(lib, suboptions, subargs)
+            )
+        return subcommand.func(lib, suboptions, subargs)
+
+    def run_cached(self, cache, key, func):
+        """Run func, writing its output to sys.stdout and the cache.
+
+        The output is held until the command has finished, and is only
+        cached if it succeeds.
+        """
+        stdout = sys.stdout
+        encoding = getattr(stdout, "encoding", None) or locale.getpreferredencoding(
+            False
+        )
+        captured = io.TextIOWrapper(
+            io.BytesIO(), encoding=encoding, errors="replace", write_through=True
+        )
+        try:
+            with redirect_stdout(captured):
+                result = func()
+        finally:
+            sink = OutputSink(stdout)
+            sink.write(captured.buffer.getvalue())
+            sink.close()
+
+        try:
+            cache.put(key, captured.buffer.getvalue())
+        except OSError as exc:
+            self.log.debug("Unable to cache the output of {}: {}", self.name, exc)
+        return result
+
+    def run_sharded(self, func, opts, args):
+        """Run a beets command function against each of the alias's libraries.
+
+        Each library is handled by a forked worker process, where possible,
+        with the output of the workers merged a line at a time. Otherwise the
+        libraries are handled in turn by this process.
+        """
+        paths = [
+            os.path.join(config.config_dir(), os.path.expanduser(path))
+            for path in self.libraries
+        ]
+        if "fork" not in multiprocessing.get_all_start_methods():
+            for path in paths:
+                run_on_library(path, func, opts, args)
+            return 0
+
+        encoding = getattr(sys.stdout, "encoding", None) or locale.getpreferredencoding(
+            False
+        )
+        context = multiprocessing.get_context("fork")
+        sys.stdout.flush()
+        sys.stderr.flush()
+        readers, processes = [], []
+        try:
+            for path in paths:
+                reader, writer = os.pipe()
+                readers.append(reader)
+                process = context.Process(
+                    target=run_on_library,
+                    args=(path, func, opts, args, writer, encoding),
+                    daemon=True,
+                )
+                process.start()
+                os.close(writer)
+                processes.append(process)
+
+            sink = OutputSink(sys.stdout)
+            for line in merge_lines_by_arrival(readers):
+                sink.write(line)
+            sink.close()
+        finally:
+            for fd in readers:
+                os.close(fd)
+            for process in processes:
+                process.join()
+
+        returncode = combine_returncodes([process.exitcode for process in processes])
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, paths)
+        return 0
+
+
+def get_output_cache():
+    """Return the configured cache for alias output, or None if disabled."""
+    directory = get_app_filename(config["alias"]["cache_dir"])
+    if directory is None:
+        return None
+    return OutputCache(directory, config["alias"]["cache_size"].get(int))
+
+
+def get_cache_key(lib, command):
+    """Return the cache key for the output of a command, or None.
+
+    The key covers the command line, the state of the library database and
+    the configuration files, and the database changes seen by this process,
+    which may not yet show in the database file. An in-memory library
+    cannot be told apart from another, so its output is not cached.
+    """
+    if lib.path == ":memory:":
+        return None
+    try:
+        st = os.stat(lib.path)
+    except OSError:
+        return None
+
+    key = [
+        CACHE_VERSION,
+        command,
+        os.fsdecode(lib.path),
+        [st.st_mtime_ns, st.st_ino, st.st_dev, st.st_size],
+        _library_generation,
+        stat_paths(get_config_paths()),
+        getattr(sys.stdout, "encoding", None),
+    ]
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+class OutputCache:
+    """Output of commands, kept on disk by key.
+
+    Each entry is a file named by its key, whose modification time is when it
+    was last used. Once the entries add up to more than max_size bytes, the
+    least recently used are removed.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get(self, key):
+        """Return the output cached for key, or None."""
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as f:
+                output = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return output
+
+    def put(self, key, output):
+        """Cache the output for key, then evict entries if over size."""
+        if len(output) > self.max_size:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        try:
+            with open(fd, "wb") as f:
+                f.write(output)
+            os.replace(tmp_path, os.path.join(self.directory, key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until within max_size."""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            total -= size
+
+
+def parse_beets_command(command):
+    """Return the subcommand, options and arguments for a beets command line."""
+    subcommand = get_command_index().get(command[0])
+    if subcommand is None:
+        raise ui.UserError(f"unknown command '{command[0]}'")
+    suboptions, subargs = subcommand.parse_args(command[1:])
+    return subcommand, suboptions, subargs
+
+
+def open_library(path):
+    """Open the library at path, with the configured directory and paths."""
+    if not os.path.exists(path):
+        raise ui.UserError(f"library {path} does not exist")
+    try:
+        lib = library.Library(
+            path,
+            config["directory"].as_filename(),
+            ui.get_path_formats(),
+            ui.get_replacements(),
+        )
+        lib.get_item(0)
+    except (sqlite3.OperationalError, sqlite3.DatabaseError) as exc:
+        raise ui.UserError(f"library {path} cannot be opened: {exc}") from exc
+    return lib
+
+
+def run_on_library(path, func, opts, args, fd=None, encoding=None):
+    """Run a beets command function against the library at path.
+
+    If fd is given, the output is written to it in the given encoding, as
+    when this is run by a worker process.
+    """
+    if fd is not None:
+        os.dup2(fd, 1)
+        os.close(fd)
+        sys.stdout = io.TextIOWrapper(
+            io.FileIO(1, "w", closefd=False), encoding=encoding, errors="replace"
+        )
+
+    try:
+        lib = open_library(path)
+    except ui.UserError as exc:
+        print(f"error: {exc}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        func(lib, opts, args)
+    finally:
+        sys.stdout.flush()
+        lib._close()
+
+
+def merge_lines_by_arrival(fds):
+    """Yield whole lines read from several file descriptors, as they arrive."""
+    with selectors.DefaultSelector() as selector:
+        for fd in fds:
+            selector.register(fd, selectors.EVENT_READ, bytearray())
+        while selector.get_map():
+            for key, _ in selector.select():
+                pending = key.data
+                data = os.read(key.fd, OUTPUT_READ_SIZE)
+                if not data:
+                    selector.unregister(key.fd)
+                    if pending:
+                        yield bytes(pending)
+                    continue
+
+                pending += data
+                end = pending.rfind(b"\n") + 1
+                if end:
+                    yield bytes(pending[:end])
+                    del pending[:end]
+
+
+def parse_args_strict(parser, args):
+    """Parse args with parser, raising ConfigError rather than exiting on error."""
+
+    def error(msg):
+        raise confuse.ConfigError(msg)
+
+    parser.error = error
+    try:
+        return parser.parse_args(args)
+    finally:
+        del parser.error
+
+
+def has_callback_options(parser, args):
+    """Return True if args may use an option with a callback action.
+
+    Callbacks, such as those of beets' format options, can have side effects
+    beyond setting option values, so such arguments must be parsed on every
+    run. This errs on the side of returning True.
+    """
+    for arg in args:
+        if arg == "--":
+            break
+        elif arg.startswith("--"):
+            options = [parser._long_opt.get(arg.split("=", 1)[0])]
+            if options[0] is None:
+                # Possibly an abbreviated long option
+                return True
+        elif arg.startswith("-") and len(arg) > 1:
+            options = [parser._short_opt.get(f"-{c}") for c in arg[1:]]
+        else:
+            continue
+
+        if any(o is not None and o.action == "callback" for o in options):
+            return True
+    return False
+
+
+class ExternalCommand(AliasCommand):
+    """An alias to run an external command."""
+
+    report_changes = True
+
+    def __init__(self, *args, **kwargs):
+        self.executable = None
+        self.feed = None
+        super().__init__(*args, **kwargs)
+
+    def configure(self):
+        """Validate the feed option."""
+        feed = self.options.get("feed")
+        self.feed = None if feed is None else LibraryFeed(self.name, feed)
+
+    def run_command(self, lib, opts, command):
+        """Run the external command."""
+        command[0] = command[0][1:]
+        if self.feed is not None:
+            return self.run_fed(lib, command)
+
+        path = self.options.get("path")
+        mode = config["alias"]["python_scripts"].as_choice(PYTHON_SCRIPT_MODES)
+        if path and mode != "subprocess" and is_python_script(path):
+            if mode == "inprocess":
+                return self.run_python_script(lib, path, command[1:])
+            if can_use_forkserver():
+                return self.fork_python_script(path, command[1:])
+
+        if not _resident.get() and self.options.get(
+            "exec", config["alias"]["exec"].get(bool)
+        ):
+            self.exec_command(lib, command)
+
+        return check_call_redirected(
+            command,
+            env=get_child_env(),
+            **self.get_spawn_options(command),
+            **get_output_options(),
+        )
+
+    def run_fed(self, lib, command):
+        """Run the external command, writing the alias's feed to it.
+
+        The feed is written by this thread, as the library connection belongs
+        to it, while the command is run from another thread. The feed is the
+        command's standard input, or an inherited file descriptor whose
+        number is given by $BEETS_ALIAS_FEED_FD.
+        """
+        reader, writer = os.pipe()
+        kwargs = {**self.get_spawn_options(command), **get_output_options()}
+        if self.feed.fd == "stdin":
+            kwargs.update(stdin=reader, env=get_child_env())
+        else:
+            kwargs.update(
+                pass_fds=(reader,),
+                close_fds=True,
+                env=get_child_env(**{FEED_FD_ENV: str(reader)}),
+            )
+
+        stream = open(writer, "wb", buffering=OUTPUT_BUFFER_SIZE)
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            future = executor.submit(
+                asyncio.run, run_process(command, handoff_fds=(reader,), **kwargs)
+            )
+            try:
+                self.feed.write(lib, stream)
+            except BrokenPipeError:
+                # The command stopped reading, which is up to it
+                pass
+            finally:
+                try:
+                    stream.close()
+                except BrokenPipeError:
+                    pass
+                returncode = future.result()
+
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command)
+        return 0
+
+    def run_python_script(self, lib, path, args):
+        """Run a Python script in the beets process, as if it were a command.
+
+        The script is run as __main__ with sys.argv and sys.path set up as
+        they would be for a child process, and with the open library and the
+        beets configuration available to it as the globals beets_lib and
+        beets_config. A non-zero exit status raises CalledProcessError, as it
+        does for a child process.
+        """
+        self.log.debug("Running {} in process", path)
+        try:
+            run_script(path, args, {"beets_lib": lib, "beets_config": config})
+        except SystemExit as exc:
+            code = exc.code
+        else:
+            code = None
+
+        if code not in (None, 0):
+            if not isinstance(code, int):
+                print(code, file=sys.stderr)
+                code = 1
+            raise subprocess.CalledProcessError(code, [path, *args])
+        return 0
+
+    def fork_python_script(self, path, args):
+        """Run a Python script in a child forked from the alias forkserver.
+
+        The forkserver has already imported beets and the loaded plugins, so
+        the child starts without the cost of a new interpreter. The child
+        gets the script's arguments, environment, working directory and
+        standard streams from this process.
+        """
+        self.log.debug("Running {} from the forkserver", path)
+        fds = [
+            None if fd is None else InheritedFd(fd)
+            for fd in map(get_fileno, (sys.stdin, sys.stdout, sys.stderr))
+        ]
+        sys.stdout.flush()
+        sys.stderr.flush()
+        process = get_forkserver_context().Process(
+            target=run_script_child,
+            args=(path, args, get_child_env(), os.getcwd(), fds),
+            name=os.path.basename(path),
+        )
+        process.start()
+        process.join()
+        exitcode = process.exitcode
+        process.close()
+        if exitcode:
+            raise subprocess.CalledProcessError(exitcode, [path, *args])
+        return 0
+
+    def get_spawn_options(self, command):
+        """Return the process options to launch command with.
+
+        With fast_spawn enabled, the executable is resolved in PATH, caching
+        the result for the alias, and close_fds disabled, which allows
+        subprocess to launch the command with posix_spawn rather than fork.
+        Python creates file descriptors non-inheritable, so this does not leak
+        the library or other files to the command.
+        """
+        if sys.platform == "win32" or not config["alias"]["fast_spawn"].get(bool):
+            return {}
+
+        key = (command[0], os.environ.get("PATH"))
+        if self.executable is None or self.executable[0] != key:
+            self.executable = (key, shutil.which(command[0]))
+
+        executable = self.executable[1]
+        if executable is None:
+            # Let subprocess report the missing command
+            return {}
+        return {"executable": executable, "close_fds": False}
+
+    def exec_command(self, lib, command):
+        """Replace the beets process with the external command, if possible.
+
+        The library is closed and the cli_exit event sent first, as beets will
+        not get the chance to. Returns if the command cannot be run this way,
+        in which case it must be run as a child process instead.
+        """
+        stdout, stderr = get_fileno(sys.stdout), get_fileno(sys.stderr)
+        if (
+            sys.platform == "win32"
+            or stdout is None
+            or stderr is None
+            or shutil.which(command[0]) is None
+        ):
+            self.log.debug("unable to exec `{}`, running it instead", command[0])
+            return
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, target in ((stdout, 1), (stderr, 2)):
+            if fd != target:
+                os.dup2(fd, target)
+
+        plugins.send("cli_exit", lib=lib)
+        lib._close()
+        os.execvp(command[0], command)  # noqa: S606
+
+
+class LibraryFeed:
+    """The items or albums of a query, to be written to an external command.
+
+    This is set up from the `feed` mapping of an alias's expanded form. The
+    objects are fetched a chunk of ids at a time, in id order, so that memory
+    use does not grow with the number of results. Each object is written with
+    only the listed fields, either as a JSON object per line, or in the
+    binary format: a record of the field names, then a record per object,
+    where each record holds a value per field as a 32-bit big-endian length
+    followed by that many bytes, or a length of 0xFFFFFFFF for a null.
+    """
+
+    def __init__(self, name, options):
+        if not isinstance(options, abc.Mapping):
+            raise confuse.ConfigError(f"alias {name}: feed must be a mapping")
+
+        self.name = name
+        self.query = options.get("query", "")
+        model = options.get("model", "item")
+        if model not in ("item", "album"):
+            raise confuse.ConfigError(
+                f"alias {name}: feed model must be item or album, not {model!r}"
+            )
+        self.model = library.Album if model == "album" else library.Item
+
+        self.fields = self.parse_fields(options.get("fields"))
+
+        self.format = options.get("format", "json")
+        if self.format not in FEED_FORMATS:
+            raise confuse.ConfigError(
+                f"alias {name}: feed format must be one of {FEED_FORMATS}"
+            )
+        self.fd = options.get("fd", "stdin")
+        if self.fd not in ("stdin", "extra"):
+            raise confuse.ConfigError(f"alias {name}: feed fd must be stdin or extra")
+        if self.fd == "extra" and sys.platform == "win32":
+            raise confuse.ConfigError(
+                f"alias {name}: feed fd extra is not supported on Windows"
+            )
+
+        try:
+            self.chunk = int(options.get("chunk", FEED_CHUNK_SIZE))
+        except (TypeError, ValueError) as exc:
+            raise confuse.ConfigError(f"alias {name}: {exc}") from exc
+        if self.chunk < 1:
+            raise confuse.ConfigError(f"alias {name}: feed chunk must be positive")
+
+    def parse_fields(self, fields):
+        """Return the configured list of fields, or the model's fixed fields."""
+        if fields is None:
+            return list(self.model._fields)
+        if isinstance(fields, str):
+            fields = fields.split()
+        if not (fields and all(isinstance(field, str) for field in fields)):
+            raise confuse.ConfigError(
+                f"alias {self.name}: feed fields must be a list of field names"
+            )
+        return fields
+
+    def objects(self, lib):
+        """Yield the matching objects, fetching a chunk of ids at a time."""
+        try:
+            query, _ = library.parse_query_string(self.query, self.model)
+        except InvalidQueryError as exc:
+            raise ui.UserError(f"alias {self.name}: {exc}") from exc
+
+        fetch = lib.albums if self.model is library.Album else lib.items
+        with lib.transaction() as tx:
+            table = self.model._table
+            last = tx.query(f"SELECT MAX(id) FROM {table}")[0][0]  # noqa: S608
+        for start in range(1, (last or 0) + 1, self.chunk):
+            ids = NumericQuery("id", f"{start}..{start + self.chunk - 1}")
+            yield from fetch(AndQuery([query, ids]), FixedFieldSort("id"))
+
+    def write(self, lib, stream):
+        """Write the matching objects to a binary stream."""
+        if self.format == "json":
+            for obj in self.objects(lib):
+                record = {
+                    field: encode_json_value(obj.get(field)) for field in self.fields
+                }
+                stream.write(json.dumps(record).encode("ascii") + b"\n")
+        else:
+            stream.write(encode_binary_record(self.fields))
+            for obj in self.objects(lib):
+                stream.write(
+                    encode_binary_record(obj.get(field) for field in self.fields)
+                )
+
+
+def encode_json_value(value):
+    """Return a field value as a value JSON can represent."""
+    if isinstance(value, bytes):
+        # Paths which are not valid in the filesystem encoding survive as
+        # escaped surrogates, which os.fsencode turns back into the bytes
+        return os.fsdecode(value)
+    return value
+
+
+def encode_binary_record(values):
+    """Return the field values of a record in the binary feed format."""
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append(struct.pack(">I", FEED_NULL_LENGTH))
+            continue
+        if isinstance(value, str):
+            value = value.encode("utf-8", "surrogateescape")
+        elif not isinstance(value, bytes):
+            value = str(value).encode("ascii")
+        parts.append(struct.pack(">I", len(value)))
+        parts.append(value)
+    return b"".join(parts)
+
+
+class FanOutCommand(ExternalCommand):
+    """An alias to run an external command for each item or album of a query.
+
+    The words of the command are beets templates, such as `$path`, which are
+    evaluated for each item or album. The arguments not used by placeholders
+    are the query, added to any `query` from the alias's expanded form. With
+    a `chunk` of more than one, a command is run for that many items at a
+    time, with each word which is a template repeated for each item. Up to
+    `jobs` commands are run at once, and their output is written in the order
+    of the items unless `ordered` is disabled.
+    """
+
+    def configure(self):
+        """Validate the each, jobs and chunk options."""
+        super().configure()
+        each = self.options["each"]
+        if each not in ("item", "album"):
+            raise confuse.ConfigError(
+                f"alias {self.name}: each must be item or album, not {each!r}"
+            )
+        if self.template.has_remainder:
+            raise confuse.ConfigError(
+                f"alias {self.name}: the {{}} placeholder cannot be used with each"
+            )
+        try:
+            self.jobs = int(self.options.get("jobs", os.cpu_count() or 1))
+            self.chunk = int(self.options.get("chunk", 1))
+        except (TypeError, ValueError) as exc:
+            raise confuse.ConfigError(f"alias {self.name}: {exc}") from exc
+        if self.jobs < 1 or self.chunk < 1:
+            raise confuse.ConfigError(
+                f"alias {self.name}: jobs and chunk must be positive"
+            )
+
+    def run_command(self, lib, opts, command):
+        """Run the external command for each matching item or album."""
+        command[0] = command[0][1:]
+        nwords = len(self.template.tokens)
+        words, query = command[:nwords], command[nwords:]
+        query = shlex.split(self.options.get("query", "")) + query
+        if self.options["each"] == "album":
+            objs = list(lib.albums(query))
+        else:
+            objs = list(lib.items(query))
+
+        commands = [
+            self.expand_templates(words, objs[i : i + self.chunk])
+            for i in range(0, len(objs), self.chunk)
+        ]
+        self.log.debug("Running {} commands, {} at a time", len(commands), self.jobs)
+        returncodes = asyncio.run(
+            run_processes(
+                commands,
+                jobs=self.jobs,
+                ordered=self.options.get("ordered", True),
+                env=get_child_env(),
+                **self.get_spawn_options(words),
+                **get_output_options(),
+            )
+        )
+
+        returncode = combine_returncodes(returncodes)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, words)
+        return 0
+
+    @staticmethod
+    def expand_templates(words, objs):
+        """Return the command for objs, evaluating each word as a template."""
+        command = []
+        for word in words:
+            if "$" in word or "%" in word:
+                template = functemplate.template(word)
+                command.extend(obj.evaluate_template(template) for obj in objs)
+            else:
+                command.append(word)
+        return command
+
+
+class PipelineCommand(AliasCommand):
+    """An alias to run a pipeline of commands, separated by `|` words.
+
+    The first stage may be a beets command, which is run by this process with
+    its output written to a pipe to the next stage, rather than through a
+    shell and another beets process. The other stages are external
+    commands. All stages run at once, with the pipes between them limiting
+    how far ahead each stage gets. The exit status is that of the last stage
+    which failed, as with the pipefail option of the shell.
+    """
+
+    report_changes = True
+
+    def __init__(self, *args, **kwargs):
+        self.stages = []
+        super().__init__(*args, **kwargs)
+
+    def configure(self):
+        """Split the pipeline into its stages, checking each."""
+        self.stages = [[]]
+        for token in self.template.tokens:
+            if token == PIPELINE_SEPARATOR:
+                self.stages.append([])
+            else:
+                self.stages[-1].append(token)
+
+        for i, stage in enumerate(self.stages):
+            if not stage:
+                raise confuse.ConfigError(f"alias {self.name}: empty pipeline stage")
+            if i and not (isinstance(stage[0], str) and stage[0].startswith("!")):
+                raise confuse.ConfigError(
+                    f"alias {self.name}: only the first stage of a pipeline "
+                    "may be a beets command"
+                )
+
+    def is_external(self):
+        """Return True if every stage of the pipeline is an external command."""
+        return bool(self.stages) and all(
+            isinstance(stage[0], str) and stage[0].startswith("!")
+            for stage in self.stages
+        )
+
+    def run_internal_pipeline(self, lib, internal, stages):
+        """Run a pipeline whose first stage is a beets command.
+
+        The beets command is run by this thread, as the library connection
+        belongs to it, while the other stages are run from another thread.
+        """
+        stdout = sys.stdout
+        if not isinstance(stdout, ThreadLocalStream):
+            sys.stdout = ThreadLocalStream(stdout)
+        reader, writer = os.pipe()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                future = executor.submit(
+                    asyncio.run,
+                    run_pipeline(
+                        stages,
+                        stdin=reader,
+                        stdout=stdout,
+                        env=get_child_env(),
+                        **get_output_options(),
+                    ),
+                )
+                try:
+                    status = run_pipeline_stage(lib, internal, writer)
+                finally:
+                    returncodes = future.result()
+        finally:
+            sys.stdout = stdout
+        return [status, *returncodes]
+
+    def split_stages(self, command):
+        """Split an expanded command into the commands of each stage."""
+        # Work out how many arguments took the place of each {}, or were
+        # appended to the last stage
+        nfixed = sum(token is not None for token in self.template.tokens)
+        nremainders = self.template.tokens.count(None) or 1
+        nrest = (len(command) - nfixed) // nremainders
+
+        stages, start = [], 0
+        for stage in self.stages:
+            end = start + sum(nrest if token is None else 1 for token in stage)
+            stages.append(command[start:end])
+            start = end + 1
+        stages[-1].extend(command[start - 1 :])
+        return stages
+
+    def run_command(self, lib, opts, command):
+        """Run the pipeline."""
+        stages = self.split_stages(command)
+        internal = None
+        if not stages[0][0].startswith("!"):
+            internal = stages.pop(0)
+        stages = [[stage[0][1:], *stage[1:]] for stage in stages]
+
+        if not internal:
+            returncodes = asyncio.run(
+                run_pipeline(stages, env=get_child_env(), **get_output_options())
+            )
+        else:
+            returncodes = self.run_internal_pipeline(lib, internal, stages)
+
+        for returncode in reversed(returncodes):
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, command)
+        return 0
+
+
+def is_pipeline(command):
+    """Return True if an alias command is a pipeline of several commands."""
+    try:
+        return PIPELINE_SEPARATOR in shlex.split(command)
+    except ValueError:
+        return False
+
+
+async def run_pipeline(stages, stdin=None, env=None, **kwargs):
+    """Run external commands in a pipeline, returning their exit codes.
+
+    If stdin is given, it is a file descriptor for the input of the first
+    stage, which is closed once it has been passed on. The output of the last
+    stage is copied to the stdout stream, as by run_process. The stages are
+    run with the environment env, if given.
+    """
+    waits = []
+    try:
+        for stage in stages[:-1]:
+            reader, writer = os.pipe()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *stage, stdin=stdin, stdout=writer, env=env
+                )
+            finally:
+                os.close(writer)
+                if stdin is not None:
+                    os.close(stdin)
+                stdin = reader
+            waits.append(proc.wait())
+
+        last = run_process(
+            stages[-1],
+            stdin=stdin,
+            handoff_fds=() if stdin is None else (stdin,),
+            env=env,
+            **kwargs,
+        )
+        stdin = None
+        results = await asyncio.gather(*waits, last, return_exceptions=True)
+    finally:
+        if stdin is not None:
+            os.close(stdin)
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+def run_pipeline_stage(lib, command, fd):
+    """Run a beets command line, writing its output to a file descriptor.
+
+    sys.stdout must be a ThreadLocalStream. Returns the exit status of the
+    command. The command stopping early, as the next stage of the pipeline
+    has stopped reading, is not a failure.
+    """
+    encoding = getattr(sys.stdout, "encoding", None) or locale.getpreferredencoding(
+        False
+    )
+    stream = open(fd, "w", encoding=encoding, errors="replace")
+    try:
+        with sys.stdout.redirect(stream):
+            subcommand, suboptions, subargs = parse_beets_command(command)
+            subcommand.func(lib, suboptions, subargs)
+            stream.flush()
+    except BrokenPipeError:
+        pass
+    except SystemExit as exc:
+        if exc.code is None or isinstance(exc.code, int):
+            return exc.code or 0
+        return 1
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+    return 0
+
+
+def combine_returncodes(returncodes):
+    """Return a single exit status for several commands.
+
+    This is the first exit status other than success or database changed,
+    otherwise database changed if any command reported it, otherwise 0.
+    """
+    for returncode in returncodes:
+        if returncode not in (0, EXIT_STATUS_DATABASE_CHANGED):
+            return returncode
+    if EXIT_STATUS_DATABASE_CHANGED in returncodes:
+        return EXIT_STATUS_DATABASE_CHANGED
+    return 0
+
+
+def get_output_options():
+    """Return the configured options for copying the output of commands."""
+    return {
+        "buffer_size": config["alias"]["output_buffer_size"].get(int),
+        "flush_interval": config["alias"]["output_flush_interval"].as_number(),
+    }
+
+
+def is_python_script(path):
+    """Return True if path is a Python script.
+
+    A script is recognized by a python interpreter in its #! line, or by a
+    `# beets-alias: python` marker line near the start of the script.
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(PYTHON_SCRIPT_HEAD_SIZE)
+    except OSError:
+        return False
+
+    lines = head.splitlines()
+    if lines and lines[0].startswith(b"#!") and b"python" in lines[0]:
+        return True
+    return any(line.strip() == b"# beets-alias: python" for line in lines)
+
+
+def run_script(path, args, init_globals=None):
+    """Run a Python script as __main__, as it would be run by python.
+
+    sys.argv and sys.path are set up for the script and restored afterwards.
+    Any SystemExit raised by the script is passed on to the caller.
+    """
+    argv, syspath = sys.argv, sys.path[:]
+    sys.argv = [path, *args]
+    sys.path.insert(0, os.path.dirname(path))
+    try:
+        runpy.run_path(path, init_globals=init_globals, run_name="__main__")
+    finally:
+        sys.argv = argv
+        sys.path[:] = syspath
+
+
+def run_script_child(path, args, env, cwd, fds):
+    """Run a Python script in a process forked from the forkserver.
+
+    multiprocessing has already pointed sys.stdin at /dev/null, so the
+    standard streams are opened again on the descriptors handed over.
+    """
+    streams = (
+        ("stdin", "r", "strict"),
+        ("stdout", "w", "strict"),
+        ("stderr", "w", "backslashreplace"),
+    )
+    for target, (fd, (name, mode, errors)) in enumerate(zip(fds, streams)):
+        if fd is None:
+            continue
+        if fd.fd != target:
+            os.dup2(fd.fd, target)
+            os.close(fd.fd)
+        stream = getattr(sys, name)
+        if stream is not None and mode == "w":
+            stream.flush()
+        setattr(sys, name, open(target, mode, errors=errors, closefd=False))
+    os.environ.clear()
+    os.environ.update(env)
+    os.chdir(cwd)
+    run_script(path, args)
+
+
+class InheritedFd:
+    """A file descriptor to hand over to a child of the forkserver."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __reduce__(self):
+        """Pickle the descriptor so that it is duplicated into the child."""
+        return InheritedFd.rebuild, (reduction.DupFd(self.fd),)
+
+    @staticmethod
+    def rebuild(dupfd):
+        """Recreate the descriptor in the child."""
+        return InheritedFd(dupfd.detach())
+
+
+def can_use_forkserver():
+    """Return True if Python scripts can be run from the forkserver."""
+    return (
+        "forkserver" in multiprocessing.get_all_start_methods()
+        and get_fileno(sys.stdout) is not None
+        and get_fileno(sys.stderr) is not None
+        and is_forkserver_importable(__name__)
+    )
+
+
+def get_forkserver_context():
+    """Return the multiprocessing context for the alias forkserver.
+
+    The forkserver is started on first use and preloads beets and the loaded
+    plugins, so that each child forked from it starts warm. Plugins which
+    the forkserver cannot import are left out, as is_forkserver_importable
+    describes.
+    """
+    global _forkserver_context
+    if _forkserver_context is None:
+        context = multiprocessing.get_context("forkserver")
+        modules = {type(p).__module__ for p in plugins.find_plugins()}
+        context.set_forkserver_preload(
+            [
+                "beets.library",
+                "beets.ui.commands",
+                "confuse",
+                *sorted(filter(is_forkserver_importable, modules)),
+            ]
+        )
+        _forkserver_context = context
+    return _forkserver_context
+
+
+def is_forkserver_importable(modname):
+    """Return True if the forkserver would import the loaded module modname.
+
+    The forkserver is a new interpreter with the same `sys.path`, so its
+    `beetsplug` package spans the `beetsplug` directories there, but beets
+    adds its `pluginpath` to `beetsplug.__path__` only in this process, so a
+    plugin found only there cannot be imported by the forkserver.
+    """
+    package, _, name = modname.rpartition(".")
+    if package != "beetsplug":
+        return True
+    found = importlib.machinery.PathFinder.find_spec(
+        name, pkgutil.extend_path([], package)
+    )
+    loaded = getattr(sys.modules.get(modname), "__spec__", None)
+    return found is not None and loaded is not None and found.origin == loaded.origin
+
+
+class ConfigSources(list):
+    """The configuration sources, noting those set by each command line.
+
+    Setting a configuration value inserts a source in front of the others. A
+    source inserted while restoring_config is active in this thread is
+    noted, so that it can be removed again without touching the sources set
+    by command lines running alongside in other threads. Defaults, which
+    are added at the end, are kept.
+    """
+
+    def insert(self, index, source):
+        """Insert a source, noting it for this thread's command line."""
+        with _config_lock:
+            changes = _config_changes.get()
+            if changes is not None:
+                changes.append(source)
+            super().insert(index, source)
+
+
+@contextlib.contextmanager
+def restoring_config(lock=None):
+    """Hold lock, if given, and undo changes made to the configuration meanwhile.
+
+    Only the sources added by this thread are removed afterwards, so that
+    commands which run alongside each other, such as readonly aliases in
+    beet alias serve, each have their changes undone without undoing those
+    of the others while they are still running.
+    """
+    with lock or contextlib.nullcontext():
+        with _config_lock:
+            if not isinstance(config.sources, ConfigSources):
+                config.sources = ConfigSources(config.sources)
+        changes = []
+        token = _config_changes.set(changes)
+        try:
+            yield
+        finally:
+            _config_changes.reset(token)
+            with _config_lock:
+                config.sources[:] = [
+                    source
+                    for source in config.sources
+                    if not any(source is change for change in changes)
+                ]
+
+
+def parse_batch_line(line):
+    """Split a line of batch input into a command and its arguments.
+
+    A line is either a JSON list of strings, or shell-quoted words, where
+    blank lines and `#` comments are ignored.
+    """
+    if line.lstrip().startswith("["):
+        try:
+            argv = json.loads(line)
+        except json.JSONDecodeError as exc:
+            raise ValueError(f"invalid JSON: {exc}") from exc
+        if not all(isinstance(arg, str) for arg in argv):
+            raise ValueError("JSON command must be a list of strings")
+        return argv
+    return shlex.split(line, comments=True)
+
+
+def is_readonly(subcommand):
+    """Return True if subcommand may run alongside commands changing the library.
+
+    This is an alias marked as readonly, or an alias which only runs child
+    processes, unless marked otherwise. The write lock guards the state of
+    this process, such as the configuration and the open library, which a
+    child does not touch, while SQLite locks the database for the child.
+    """
+    if not isinstance(subcommand, AliasCommand):
+        return False
+    external = isinstance(subcommand, ExternalCommand) or (
+        isinstance(subcommand, PipelineCommand) and subcommand.is_external()
+    )
+    return bool(subcommand.options.get("readonly", external))
+
+
+class CronExpression:
+    """A cron expression of minute, hour, day of month, month and day of week.
+
+    Each field is `*`, a number, or a range `a-b`, optionally with a step
+    `/n`, or a comma separated list of those. As in cron, when both the day
+    of month and day of week are restricted, a day matching either is used.
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != len(self.FIELDS):
+            raise ValueError(f"cron expression '{expression}' must have 5 fields")
+
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self.parse_field(field, low, high)
+            for field, (low, high) in zip(fields, self.FIELDS)
+        )
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = fields[2] == "*" or fields[4] == "*"
+
+    @staticmethod
+    def parse_field(field, low, high):
+        """Return the set of values matched by a field of a cron expression."""
+        values = set()
+        for part in field.split(","):
+            span, _, step = part.partition("/")
+            try:
+                if span == "*":
+                    start, end = low, high
+                elif "-" in span:
+                    start, end = map(int, span.split("-", 1))
+                else:
+                    start = int(span)
+                    end = high if step else start
+                step = int(step) if step else 1
+            except ValueError:
+                start = end = step = None
+            if start is None or not low <= start <= end <= high or step < 1:
+                raise ValueError(f"invalid cron field '{field}'")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def matches_day(self, when):
+        """Return True if the date of when matches the expression."""
+        day = when.day in self.days
+        weekday = when.isoweekday() % 7 in self.weekdays
+        if self.any_day:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, when):
+        """Return the first datetime matching the expression after when."""
+        when = when.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = when + datetime.timedelta(days=5 * 366)
+        while when < limit:
+            if when.month not in self.months:
+                when = when.replace(day=1, hour=0, minute=0)
+                when = (when + datetime.timedelta(days=32)).replace(day=1)
+            elif not self.matches_day(when):
+                when = when.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0) + datetime.timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += datetime.timedelta(minutes=1)
+            else:
+                return when
+        raise ValueError("cron expression never matches")
+
+
+class AliasSchedule:
+    """When to run a scheduled alias, from the `schedule` of its mapping.
+
+    The schedule has either an `interval` in seconds or a `cron` expression,
+    and optionally a random `jitter` in seconds added to each run, and the
+    `max_concurrency` of runs of the alias, which defaults to 1.
+    """
+
+    def __init__(self, name, options):
+        if not isinstance(options, abc.Mapping):
+            raise confuse.ConfigError(f"alias {name}: schedule must be a mapping")
+        if ("interval" in options) == ("cron" in options):
+            raise confuse.ConfigError(
+                f"alias {name}: schedule must have one of interval or cron"
+            )
+
+        try:
+            self.interval = options.get("interval")
+            if self.interval is not None:
+                self.interval = float(self.interval)
+                if self.interval <= 0:
+                    raise ValueError("interval must be positive")
+            self.cron = options.get("cron")
+            if self.cron is not None:
+                self.cron = CronExpression(self.cron)
+            self.jitter = float(options.get("jitter", 0))
+            self.max_concurrency = int(options.get("max_concurrency", 1))
+        except (TypeError, ValueError) as exc:
+            raise confuse.ConfigError(f"alias {name}: schedule: {exc}") from exc
+
+    def next_run(self, after):
+        """Return the time of the next run after a time, without jitter."""
+        if self.interval is not None:
+            return after + self.interval
+        when = datetime.datetime.fromtimestamp(after)
+        return self.cron.next_after(when).timestamp()
+
+    def jittered(self, when):
+        """Return when, delayed by a random part of the jitter."""
+        return when + random.uniform(0, self.jitter)  # noqa: S311
+
+
+class AliasScheduler:
+    """Run scheduled aliases when they are due, against one open library.
+
+    A run is skipped when the alias already has as many runs in progress as
+    its schedule allows. The start, duration and exit status of each run are
+    appended to the history file, as JSON lines.
+    """
+
+    def __init__(self, plugin, lib, schedules, history=None):
+        self.plugin = plugin
+        self.lib = lib
+        self.schedules = schedules
+        self.history = history
+        self.running = dict.fromkeys(schedules, 0)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run(self):
+        """Run aliases as they become due, until stopped."""
+        now = time.time()
+        bases = {name: s.next_run(now) for name, s in self.schedules.items()}
+        due = {name: s.jittered(bases[name]) for name, s in self.schedules.items()}
+        while True:
+            name = min(due, key=due.get)
+            if self.stopped.wait(max(0, due[name] - time.time())):
+                break
+            self.start(name)
+
+            schedule = self.schedules[name]
+            bases[name] = schedule.next_run(bases[name])
+            if bases[name] <= time.time():
+                bases[name] = schedule.next_run(time.time())
+            due[name] = schedule.jittered(bases[name])
+
+    def stop(self):
+        """Stop scheduling aliases."""
+        self.stopped.set()
+
+    def join(self):
+        """Wait for the runs in progress to finish."""
+        for thread in self.threads:
+            thread.join()
+
+    def start(self, name):
+        """Start a run of an alias, unless too many are in progress."""
+        with self.lock:
+            if self.running[name] >= self.schedules[name].max_concurrency:
+                self.plugin._log.info("skipping {}, as it is still running", name)
+                return
+            self.running[name] += 1
+            self.threads = [t for t in self.threads if t.is_alive()]
+            thread = threading.Thread(target=self.run_alias, args=(name,), name=name)
+            self.threads.append(thread)
+        thread.start()
+
+    def run_alias(self, name):
+        """Run an alias, and record how long it took and its exit status.
+
+        The alias is run by run_invocation, so an exec alias is run as a
+        child rather than replacing the scheduler.
+        """
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            status = self.plugin.run_invocation(self.lib, [name], self.write_lock)
+        except Exception:
+            self.plugin._log.error("{} failed: {}", name, traceback.format_exc())
+            status = 1
+        finally:
+            with self.lock:
+                self.running[name] -= 1
+        duration = time.perf_counter() - start
+
+        self.plugin._log.info("{} exited with {} after {:.3f}s", name, status, duration)
+        self.record(
+            {"alias": name, "start": started, "duration": duration, "exit": status}
+        )
+
+    def record(self, entry):
+        """Append an entry to the history file."""
+        if not self.history:
+            return
+        try:
+            with self.lock, open(self.history, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+        except OSError as exc:
+            self.plugin._log.warning("unable to write {}: {}", self.history, exc)
+
+
+class AliasServer(socketserver.ThreadingUnixStreamServer):
+    """Serve alias clients, each connection running one command line.
+
+    Commands run in a thread per connection against a single open library.
+    Beets commands other than aliases marked as readonly are run one at a
+    time.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, plugin, lib):
+        self.plugin = plugin
+        self.lib = lib
+        self.write_lock = threading.Lock()
+        super().__init__(path, AliasRequestHandler)
+
+    def run_request(self, argv, send):
+        """Run a command line, sending its output to the client."""
+        self.plugin.reload_if_changed()
+        with sys.stdout.redirect(ClientStream("stdout", send)), sys.stderr.redirect(
+            ClientStream("stderr", send)
+        ):
+            try:
+                return self.plugin.run_invocation(self.lib, argv, self.write_lock)
+            except Exception as exc:
+                self.plugin._log.debug("{}", traceback.format_exc())
+                print(f"error: {exc}", file=sys.stderr)
+                return 1
+
+
+class AliasRequestHandler(socketserver.StreamRequestHandler):
+    """Handle a connection from an alias client.
+
+    The client sends a line holding a JSON object with the command line as
+    `argv`. The server replies with JSON lines holding `stdout` or `stderr`
+    text as it is written, and finally the `exit` status of the command.
+    """
+
+    def handle(self):
+        """Run the command line sent by the client."""
+        try:
+            argv = json.loads(self.rfile.readline())["argv"]
+        except (ValueError, KeyError, TypeError):
+            argv = None
+        if not argv or not all(isinstance(arg, str) for arg in argv):
+            self.send({"stderr": "error: invalid request\n"})
+            self.send({"exit": 2})
+            return
+
+        self.send({"exit": self.server.run_request(argv, self.send)})
+
+    def send(self, message):
+        """Send a message to the client, ignoring a closed connection."""
+        try:
+            self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+        except OSError:
+            pass
+
+
+def redirect_stdout(stream):
+    """Redirect sys.stdout to stream, for this thread if sys.stdout allows."""
+    if isinstance(sys.stdout, ThreadLocalStream):
+        return sys.stdout.redirect(stream)
+    return contextlib.redirect_stdout(stream)
+
+
+class ThreadLocalStream:
+    """A standard stream which may be redirected for the current thread."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def redirect(self, stream):
+        """Redirect writes from the current thread to stream."""
+        self.local.stream = stream
+        try:
+            yield stream
+        finally:
+            self.local.stream = None
+
+    def __getattr__(self, name):
+        """Look up name on the stream for the current thread."""
+        return getattr(getattr(self.local, "stream", None) or self.stream, name)
+
+
+class ClientStream:
+    """A text stream sending what is written to an alias client."""
+
+    encoding = "utf-8"
+
+    def __init__(self, name, send):
+        self.name = name
+        self.send = send
+
+    def write(self, text):
+        """Send text to the client."""
+        if text:
+            self.send({self.name: text})
+        return len(text)
+
+    def flush(self):
+        """Do nothing, as text is sent as it is written."""
+
+    def isatty(self):
+        """Return False, as the client is not a terminal."""
+        return False
+
+
+class DeadlineMap:
+    """Call a function on each of a set of items from a pool of daemon threads.
+
+    If a call is still running `timeout` seconds after it started, it is
+    abandoned and its thread replaced. Daemon threads are used so that a call
+    blocked on a hung network mount can never delay interpreter exit.
+    """
+
+    def __init__(self, func, items, workers, timeout):
+        self.func = func
+        self.items = list(items)
+        self.workers = min(max(workers, 1), len(self.items))
+        self.timeout = timeout
+        self.pending = queue.SimpleQueue()
+        self.done = queue.SimpleQueue()
+        self.started = {}
+        self.lock = threading.Lock()
+
+    def worker(self):
+        """Call func on pending items until there are none left."""
+        while True:
+            try:
+                item = self.pending.get_nowait()
+            except queue.Empty:
+                return
+
+            with self.lock:
+                self.started[item] = time.monotonic()
+            try:
+                result = self.func(item)
+            except Exception as exc:
+                result = exc
+            self.done.put((item, result))
+
+    def spawn_worker(self):
+        """Start a new worker thread."""
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def run(self):
+        """Return a dict mapping each item to its result.
+
+        Items whose call raised map to the exception, and items whose call
+        timed out map to a TimeoutError.
+        """
+        for item in self.items:
+            self.pending.put(item)
+        for _ in range(self.workers):
+            self.spawn_worker()
+
+        results = {}
+        while len(results) < len(self.items):
+            with self.lock:
+                running = [(t, i) for i, t in self.started.items() if i not in results]
+            if running:
+                wait = min(t for t, _ in running) + self.timeout - time.monotonic()
+            else:
+                wait = self.timeout
+
+            try:
+                item, result = self.done.get(timeout=max(wait, 0))
+            except queue.Empty:
+                self.expire(running, results)
+            else:
+                results.setdefault(item, result)
+        return results
+
+    def expire(self, running, results):
+        """Record a TimeoutError for running calls which passed their deadline."""
+        now = time.monotonic()
+        for started, item in running:
+            if started + self.timeout <= now:
+                results[item] = TimeoutError(f"timed out after {self.timeout}s")
+                self.spawn_worker()
+
+
+def get_fileno(stream):
+    """Return the file descriptor of stream, or None if it has none."""
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class OutputSink:
+    """Write binary output from a child process to a text stream.
+
+    Output is coalesced into writes of up to buffer_size bytes, and written
+    out at least every flush_interval seconds. If the stream is a terminal,
+    it is also written out at the end of each line.
+
+    If the stream is a text stream over a binary buffer, the data is written
+    to the buffer as is, rather than being decoded and re-encoded.
+    """
+
+    def __init__(self, stream, buffer_size=None, flush_interval=None):
+        self.stream = stream
+        self.buffer_size = buffer_size or OUTPUT_BUFFER_SIZE
+        self.flush_interval = flush_interval or OUTPUT_FLUSH_INTERVAL
+        self.pending = bytearray()
+        self.last_flush = time.monotonic()
+        try:
+            self.line_buffered = stream.isatty()
+        except (AttributeError, OSError, ValueError):
+            self.line_buffered = False
+
+        self.buffer = getattr(stream, "buffer", None)
+        if self.buffer is not None:
+            stream.flush()
+        else:
+            encoding = locale.getpreferredencoding(False)
+            self.decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+
+    def timeout(self):
+        """Return the number of seconds until pending output is due to be written."""
+        if not self.pending:
+            return None
+        return max(self.last_flush + self.flush_interval - time.monotonic(), 0)
+
+    def write(self, data):
+        """Add a chunk of data, writing out the pending output if it is due."""
+        self.pending += data
+        if (
+            len(self.pending) >= self.buffer_size
+            or (self.line_buffered and b"\n" in data)
+            or self.timeout() == 0
+        ):
+            self.flush()
+
+    def flush(self):
+        """Write out the pending output."""
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+
+        if self.buffer is not None:
+            self.buffer.write(self.pending)
+            self.buffer.flush()
+        else:
+            self.stream.write(self.decoder.decode(self.pending))
+            self.stream.flush()
+        self.pending.clear()
+
+    def close(self):
+        """Write out the pending output and any partially decoded data."""
+        self.flush()
+        if self.buffer is None:
+            self.stream.write(self.decoder.decode(b"", final=True))
+            self.stream.flush()
+
+
+async def copy_output(reader, sink):
+    """Copy data from an asyncio stream reader to sink until end of file."""
+    try:
+        while True:
+            try:
+                data = await asyncio.wait_for(
+                    reader.read(OUTPUT_READ_SIZE), sink.timeout()
+                )
+            except asyncio.TimeoutError:
+                sink.flush()
+                continue
+
+            if not data:
+                break
+            sink.write(data)
+    finally:
+        sink.close()
+
+
+async def run_process(
+    args,
+    stdout=None,
+    stderr=None,
+    buffer_size=None,
+    flush_interval=None,
+    handoff_fds=(),
+    **kwargs,
+):
+    """Run a process, copying its output to the stdout and stderr streams.
+
+    The streams default to sys.stdout and sys.stderr. A stream backed by a
+    file descriptor is inherited by the child. Otherwise the child's output is
+    read from a pipe without blocking, by the event loop, so any number of
+    processes can be run concurrently from a single thread. See OutputSink
+    for buffer_size and flush_interval. The file descriptors in handoff_fds,
+    such as a pipe given as stdin, are closed once passed to the child.
+
+    Returns the exit code of the process.
+    """
+    copies = []
+    streams = (
+        ("stdout", sys.stdout if stdout is None else stdout),
+        ("stderr", sys.stderr if stderr is None else stderr),
+    )
+    for (name, stream), std_fd in zip(streams, (1, 2)):
+        fd = get_fileno(stream)
+        if fd is None:
+            kwargs[name] = subprocess.PIPE
+            copies.append((name, OutputSink(stream, buffer_size, flush_interval)))
+        else:
+            stream.flush()
+            # Leave the standard descriptors alone, as passing them explicitly
+            # rules out subprocess's posix_spawn fast path
+            kwargs[name] = None if fd == std_fd else fd
+
+    try:
+        proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+    finally:
+        for fd in handoff_fds:
+            os.close(fd)
+    await asyncio.gather(
+        *(copy_output(getattr(proc, name), sink) for name, sink in copies)
+    )
+    return await proc.wait()
+
+
+async def run_processes(
+    commands, jobs=None, ordered=False, stdout=None, stderr=None, **kwargs
+):
+    """Run processes concurrently, returning their exit codes in order.
+
+    Their output is copied to the stdout and stderr streams, as for
+    run_process. At most jobs processes are run at once, if set. If ordered
+    is set, the output of each process is held until the processes before it
+    have finished, so the output of each is written in full, in order.
+    """
+    semaphore = asyncio.Semaphore(jobs or max(len(commands), 1))
+
+    async def run(command, stdout, stderr):
+        async with semaphore:
+            return await run_process(command, stdout, stderr, **kwargs)
+
+    if not ordered:
+        return await asyncio.gather(
+            *(run(command, stdout, stderr) for command in commands)
+        )
+
+    outputs = [
+        (io.TextIOWrapper(io.BytesIO()), io.TextIOWrapper(io.BytesIO()))
+        for _ in commands
+    ]
+    tasks = [
+        asyncio.ensure_future(run(command, *output))
+        for command, output in zip(commands, outputs)
+    ]
+    returncodes = []
+    try:
+        for task, output in zip(tasks, outputs):
+            returncodes.append(await task)
+            streams = (stdout or sys.stdout, stderr or sys.stderr)
+            for captured, stream in zip(output, streams):
+                sink = OutputSink(stream)
+                sink.write(captured.buffer.getvalue())
+                sink.close()
+    finally:
+        for task in tasks:
+            task.cancel()
+    return returncodes
+
+
+def check_call_redirected(args, **kwargs):
+    """Like subprocess.check_call, but redirects the output to sys.stdout/sys.stderr.
+
+    This is used to ensure that we can capture the output in the tests. When
+    sys.stdout or sys.stderr is backed by a real file descriptor, as it is
+    outside of tests, the child inherits that descriptor and its output is
+    not copied through this process at all.
+    """
+    returncode = asyncio.run(run_process(args, **kwargs))
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args)
     return 0
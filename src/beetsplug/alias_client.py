@@ -0,0 +1,107 @@
+"""Client for the alias server run by `beet alias serve`.
+
+The client sends a beet command line to the server over its Unix socket,
+writes the output of the command as it arrives, and exits with the exit
+status of the command. It does not import beets, so it starts much faster
+than running beet itself. If no server is running, beet is run instead.
+
+Example:
+    $ beets-alias-client list-live yello live
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+from typing import List
+from typing import Optional
+from typing import TextIO
+
+
+def default_socket_path() -> str:
+    """Return the default path of the alias server socket.
+
+    This is $BEETS_ALIAS_SOCKET if set, or alias.sock in the beets
+    configuration directory otherwise.
+    """
+    path = os.environ.get("BEETS_ALIAS_SOCKET")
+    if path:
+        return path
+
+    beetsdir = os.environ.get("BEETSDIR")
+    if beetsdir:
+        return os.path.join(os.path.expanduser(beetsdir), "alias.sock")
+
+    config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.join("~", ".config")
+    return os.path.join(os.path.expanduser(config_home), "beets", "alias.sock")
+
+
+def write(stream: TextIO, text: str) -> None:
+    """Write text to stream, replacing characters it cannot encode."""
+    buffer = getattr(stream, "buffer", None)
+    if buffer is None:
+        stream.write(text)
+    else:
+        buffer.write(text.encode(stream.encoding or "utf-8", "replace"))
+    stream.flush()
+
+
+def run(path: str, argv: List[str]) -> int:
+    """Run a command line on the alias server, returning its exit status.
+
+    Raises:
+        ConnectionError: if the server could not be reached.
+    """
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError) as exc:
+            raise ConnectionError(str(exc)) from exc
+
+        sock.sendall(json.dumps({"argv": argv}).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as replies:
+            for line in replies:
+                message = json.loads(line)
+                if "stdout" in message:
+                    write(sys.stdout, message["stdout"])
+                if "stderr" in message:
+                    write(sys.stderr, message["stderr"])
+                if "exit" in message:
+                    return int(message["exit"])
+
+    write(sys.stderr, "error: lost connection to the alias server\n")
+    return 1
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    """Run the command line given as arguments on the alias server."""
+    parser = argparse.ArgumentParser(
+        description="Run a beet command line on the alias server."
+    )
+    parser.add_argument(
+        "-s", "--socket", default=None, help="path of the alias server socket"
+    )
+    parser.add_argument(
+        "--no-fallback",
+        action="store_true",
+        help="fail rather than run beet if no server is running",
+    )
+    parser.add_argument("command", help="beet command or alias to run")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="its arguments")
+    opts = parser.parse_args(args)
+
+    argv = [opts.command, *opts.args]
+    path = opts.socket or default_socket_path()
+    try:
+        status = run(path, argv)
+    except ConnectionError as exc:
+        if opts.no_fallback:
+            write(sys.stderr, f"error: cannot connect to {path}: {exc}\n")
+            sys.exit(1)
+        os.execvp("beet", ["beet", *argv])  # noqa: S606, S607
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,24 @@
 """Tests for the 'alias' plugin."""
 
+import asyncio
+import io
+import json
 import os
+import re
+import subprocess
 import sys
+import threading
+import time
 import unittest
 from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
 from typing import Any
 from typing import Dict
 from typing import Generator
 from typing import List
 from typing import Optional
+from unittest.mock import patch
 
 import beets.plugins  # type: ignore
 import pytest
@@ -185,6 +194,359 @@ class AliasPluginTest(BeetsTestCase):
         output = self.run_with_output("hello", "world", "beets", "extra")
         self.assertIn("Hello world, I'm a beets extra plugin", output)
 
+    def test_alias_run_external_param_subst_quoting(self) -> None:
+        """Test that substituted parameters are not split or unquoted."""
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {"lines": "!printf '%s\\n' {1} x{0}y {}"},
+            }
+        )
+        output = self.run_with_output("lines", "a b", "'c'", "d e")
+        self.assertEqual(output, "'c'\nxa by\nd e\n")
+
+    def test_alias_run_external_param_subst_missing(self) -> None:
+        """Test that placeholders without a matching parameter are kept."""
+        self._setup_config({"from_path": False, "aliases": {"hello": "!echo {0} {1}"}})
+        output = self.run_with_output("hello", "world")
+        self.assertEqual(output, "world {1}\n")
+
+    def test_config_invalid_command_syntax(self) -> None:
+        """Test alias with an unterminated quote."""
+        self._setup_config({"from_path": False, "aliases": {"hello": "!echo 'a"}})
+        with self.assertRaisesRegex(ConfigError, "alias hello: No closing quotation"):
+            self.run_with_output("hello")
+
+    def test_alias_run_external_passthrough(self) -> None:
+        """Test that an external command inherits a real stdout."""
+        self._setup_config()
+        output_path = Path(os.fsdecode(self.temp_dir)) / "output.txt"
+        with open(output_path, "w") as output, patch.object(sys, "stdout", output):
+            print("before", flush=False)
+            self.run_command("hello", "world")
+            print("after")
+        self.assertEqual(
+            output_path.read_text(), "before\nHello world, I'm a plugin\nafter\n"
+        )
+
+    def test_alias_run_external_binary_redirect(self) -> None:
+        """Test that output is copied as bytes to a stdout without a descriptor."""
+        self._setup_config()
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+        with patch.object(sys, "stdout", stdout):
+            self.run_command("echo", "h\u00e9llo")
+        self.assertEqual(stdout.buffer.getvalue(), "h\u00e9llo\n".encode())
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_run_processes(self) -> None:
+        """Test running several external commands concurrently."""
+        from beetsplug.alias import run_processes
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        commands = [
+            ["sh", "-c", f"sleep 0.5; echo out{i}; echo err{i} >&2; exit {i}"]
+            for i in range(4)
+        ]
+        start = time.monotonic()
+        returncodes = asyncio.run(run_processes(commands, stdout=stdout, stderr=stderr))
+        self.assertLess(time.monotonic() - start, 1.5)
+
+        self.assertEqual(returncodes, [0, 1, 2, 3])
+        self.assertEqual(
+            sorted(stdout.getvalue().splitlines()), [f"out{i}" for i in range(4)]
+        )
+        self.assertEqual(
+            sorted(stderr.getvalue().splitlines()), [f"err{i}" for i in range(4)]
+        )
+
+    def test_run_processes_ordered(self) -> None:
+        """Test running external commands with a limit, writing output in order."""
+        from beetsplug.alias import run_processes
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        commands = [
+            ["sh", "-c", f"sleep {delay}; echo out{i}; echo err{i} >&2"]
+            for i, delay in enumerate([0.3, 0.2, 0.2, 0.1])
+        ]
+        start = time.monotonic()
+        returncodes = asyncio.run(
+            run_processes(commands, jobs=2, ordered=True, stdout=stdout, stderr=stderr)
+        )
+        self.assertGreater(time.monotonic() - start, 0.35)
+
+        self.assertEqual(returncodes, [0, 0, 0, 0])
+        self.assertEqual(stdout.getvalue(), "out0\nout1\nout2\nout3\n")
+        self.assertEqual(stderr.getvalue(), "err0\nerr1\nerr2\nerr3\n")
+
+    def test_output_sink_buffering(self) -> None:
+        """Test that output is coalesced until the buffer size is reached."""
+        from beetsplug.alias import OutputSink
+
+        stream = io.StringIO()
+        sink = OutputSink(stream, buffer_size=8, flush_interval=60)
+        sink.write(b"abc\n")
+        self.assertEqual(stream.getvalue(), "")
+        sink.write(b"def\n")
+        self.assertEqual(stream.getvalue(), "abc\ndef\n")
+        sink.write(b"\xc3")
+        sink.write(b"\xa9")
+        self.assertEqual(stream.getvalue(), "abc\ndef\n")
+        sink.close()
+        self.assertEqual(stream.getvalue(), "abc\ndef\n\u00e9")
+
+    def test_output_sink_terminal(self) -> None:
+        """Test that output to a terminal is written at the end of each line."""
+        from beetsplug.alias import OutputSink
+
+        stream = io.StringIO()
+        with patch.object(stream, "isatty", return_value=True):
+            sink = OutputSink(stream, buffer_size=1024, flush_interval=60)
+        sink.write(b"abc")
+        self.assertEqual(stream.getvalue(), "")
+        sink.write(b"\ndef")
+        self.assertEqual(stream.getvalue(), "abc\ndef")
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_output_flush_interval(self) -> None:
+        """Test that buffered output is written when the interval passes."""
+        from beetsplug.alias import run_process
+
+        class Stream(io.StringIO):
+            def __init__(self) -> None:
+                super().__init__()
+                self.writes: List[float] = []
+
+            def write(self, s: str) -> int:
+                if s:
+                    self.writes.append(time.monotonic())
+                return super().write(s)
+
+        stream = Stream()
+        start = time.monotonic()
+        command = ["sh", "-c", "echo a; sleep 1; echo b"]
+        asyncio.run(run_process(command, stdout=stream, flush_interval=0.1))
+        self.assertEqual(stream.getvalue(), "a\nb\n")
+        self.assertEqual(len(stream.writes), 2)
+        self.assertLess(stream.writes[0] - start, 0.8)
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_alias_run_external_exec(self) -> None:
+        """Test that an exec alias replaces the beets process."""
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {"hello": {"command": "!echo Hello {0}", "exec": True}},
+            }
+        )
+        output_path = Path(os.fsdecode(self.temp_dir)) / "output.txt"
+        with open(output_path, "w") as output, patch.object(
+            sys, "stdout", output
+        ), patch("os.dup2") as dup2, patch(
+            "os.execvp", side_effect=SystemExit(0)
+        ) as execvp, patch("tempfile.mkstemp") as mkstemp:
+            with self.assertFiresEvent("cli_exit"):
+                self.run_command("hello", "world")
+            dup2.assert_any_call(output.fileno(), 1)
+
+        execvp.assert_called_once_with("echo", ["echo", "Hello", "world"])
+        # No file for reporting changes is left behind by the exec
+        mkstemp.assert_not_called()
+
+    def test_alias_run_external_exec_captured(self) -> None:
+        """Test that an exec alias is run as a child when output is captured."""
+        self._setup_config({"from_path": False, "aliases": {"bye": '!echo "Goodbye!"'}})
+        self.config["alias"]["exec"] = True
+
+        with patch("os.execvp") as execvp:
+            output = self.run_with_output("bye")
+        self.assertEqual(output, "Goodbye!\n")
+        execvp.assert_not_called()
+
+    @pytest.mark.skipif(
+        not getattr(subprocess, "_USE_POSIX_SPAWN", False),
+        reason="subprocess does not use posix_spawn on this platform",
+    )
+    def test_alias_run_external_fast_spawn(self) -> None:
+        """Test that external commands are launched with posix_spawn."""
+        self._setup_config()
+        with patch("os.posix_spawn", wraps=os.posix_spawn) as posix_spawn:
+            output = self.run_with_output("echo", "hello")
+            self.assertEqual(output, "hello\n")
+            posix_spawn.assert_called_once()
+
+            self.config["alias"]["fast_spawn"] = False
+            output = self.run_with_output("echo", "hello")
+            self.assertEqual(output, "hello\n")
+            posix_spawn.assert_called_once()
+
+    def test_alias_run_external_each(self) -> None:
+        """Test running an external command for each item of a query."""
+        for i in range(4):
+            self.add_item(title=f"t{i}", artist="x" if i < 3 else "y", track=i)
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {
+                    "titles": {"command": "!echo $title-$artist", "each": "item"},
+                    "chunked": {
+                        "command": "!echo {0} $title",
+                        "each": "item",
+                        "query": "artist:x",
+                        "chunk": 2,
+                        "jobs": 1,
+                    },
+                    "check": {"command": "!test $track -lt 1", "each": "item"},
+                },
+            }
+        )
+
+        output = self.run_with_output("titles", "artist:x")
+        self.assertEqual(output, "t0-x\nt1-x\nt2-x\n")
+
+        output = self.run_with_output("chunked", "hi")
+        self.assertEqual(output, "hi t0 t1\nhi t2\n")
+
+        with self.assertRaises(SystemExit) as exc, self.assertFiresEvent(
+            "alias_failed", alias="check", exitcode=1
+        ) as events:
+            self.run_with_output("check")
+        self.assertEqual(exc.exception.code, 1)
+        self.assertEqual([e for e, _ in events].count("alias_failed"), 1)
+
+    def test_config_invalid_each(self) -> None:
+        """Test that invalid per-item alias options are rejected."""
+        for options, message in [
+            ({"each": "track"}, "each must be item or album"),
+            ({"each": "item", "command": "!echo {}"}, "cannot be used with each"),
+            ({"each": "item", "jobs": 0}, "jobs and chunk must be positive"),
+        ]:
+            self._setup_config(
+                {
+                    "from_path": False,
+                    "aliases": {"each": {"command": "!echo $path", **options}},
+                }
+            )
+            with self.assertRaisesRegex(ConfigError, f"alias each: .*{message}"):
+                self.run_with_output("each")
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_alias_run_external_feed(self) -> None:
+        """Test streaming library data to an external command."""
+        for title in ["a", "b", "c"]:
+            self.add_item(title=title, artist="x" if title != "c" else "y")
+        reader = self._write_python_script(
+            "read-feed",
+            "import os, struct, sys\n"
+            "stream = os.fdopen(int(os.environ['BEETS_ALIAS_FEED_FD']), 'rb')\n"
+            "data = stream.read()\n"
+            "while data:\n"
+            "    (size,) = struct.unpack('>I', data[:4])\n"
+            "    print(data[4 : 4 + size].decode(), sys.argv[1])\n"
+            "    data = data[4 + size :]\n",
+        )
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {
+                    "feed-json": {
+                        "command": "!cat",
+                        "feed": {"query": "artist:x", "fields": ["title", "artist"]},
+                    },
+                    "feed-binary": {
+                        "command": f"!{reader}",
+                        "feed": {
+                            "fields": "title",
+                            "format": "binary",
+                            "fd": "extra",
+                            "chunk": 2,
+                        },
+                    },
+                    "feed-head": {"command": "!head -c 1", "feed": {"chunk": 1}},
+                },
+            }
+        )
+
+        output = self.run_with_output("feed-json")
+        self.assertEqual(
+            [json.loads(line) for line in output.splitlines()],
+            [{"title": "a", "artist": "x"}, {"title": "b", "artist": "x"}],
+        )
+
+        output = self.run_with_output("feed-binary", "arg")
+        self.assertEqual(output, "title arg\na arg\nb arg\nc arg\n")
+
+        output = self.run_with_output("feed-head")
+        self.assertEqual(output, "{")
+
+    def test_config_invalid_feed(self) -> None:
+        """Test that invalid feed options are rejected."""
+        for feed, message in [
+            ("title", "feed must be a mapping"),
+            ({"model": "track"}, "feed model must be item or album"),
+            ({"fields": []}, "feed fields must be a list"),
+            ({"format": "xml"}, "feed format must be one of"),
+            ({"fd": 3}, "feed fd must be stdin or extra"),
+        ]:
+            self._setup_config(
+                {
+                    "from_path": False,
+                    "aliases": {"feed": {"command": "!cat", "feed": feed}},
+                }
+            )
+            with self.assertRaisesRegex(ConfigError, f"alias feed: {message}"):
+                self.run_with_output("feed")
+
+    def test_alias_pipeline(self) -> None:
+        """Test aliases which run a pipeline of commands."""
+        for title in ["c", "a", "b"]:
+            self.add_item(title=title, artist="x")
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {
+                    "titles-upper": "ls -f $title artist:{0} | !sort | !tr a-z A-Z",
+                    "upper": "!echo {} | !tr a-z A-Z",
+                    "fail": "!false | !cat",
+                },
+            }
+        )
+
+        output = self.run_with_output("titles-upper", "x")
+        self.assertEqual(output, "A\nB\nC\n")
+
+        output = self.run_with_output("upper", "hello", "world")
+        self.assertEqual(output, "HELLO WORLD\n")
+
+        with self.assertRaises(SystemExit) as exc, self.assertFiresEvent(
+            "alias_failed", alias="fail", exitcode=1
+        ):
+            self.run_with_output("fail")
+        self.assertEqual(exc.exception.code, 1)
+
+    def test_alias_pipeline_early_exit(self) -> None:
+        """Test a pipeline whose last stage stops reading early."""
+        from beets.library import Item
+
+        with self.lib.transaction():
+            for i in range(1000):
+                self.lib.add(Item(title=f"{i:0100}", path=f"/music/{i}.mp3"))
+        self._setup_config(
+            {"from_path": False, "aliases": {"first": "ls -f $title | !head -n 1"}}
+        )
+
+        output = self.run_with_output("first")
+        self.assertEqual(len(output.splitlines()), 1)
+
+    def test_config_invalid_pipeline(self) -> None:
+        """Test that invalid pipelines are rejected."""
+        for command, message in [
+            ("!echo | ls", "only the first stage of a pipeline may be a beets command"),
+            ("ls |", "empty pipeline stage"),
+        ]:
+            self._setup_config({"from_path": False, "aliases": {"pipe": command}})
+            with self.assertRaisesRegex(ConfigError, f"alias pipe: {message}"):
+                self.run_with_output("pipe")
+
     def test_alias_run_internal(self) -> None:
         """Test alias run internal command."""
         self._setup_config()
@@ -213,6 +575,63 @@ class AliasPluginTest(BeetsTestCase):
         output = self.run_with_output("config-paths-alias")
         self.assertEqual(output, f"{self.config_path}\n")
 
+    def test_alias_template_compose(self) -> None:
+        """Test composing an alias template with the template it runs."""
+        from beetsplug.alias import AliasTemplate
+
+        for outer, inner in [
+            ("b {1}", "ls artist:{0}"),
+            ("b x {} ", "ls {1} -- {}"),
+            ("b {0}-{2}", "ls {0} a{1}b {3}"),
+            ("b x y", "ls {}"),
+        ]:
+            composed = AliasTemplate.compile(outer).compose(
+                AliasTemplate.compile(inner)
+            )
+            for nargs in range(5):
+                args = [f"arg{i}" for i in range(nargs)]
+                command, _ = AliasTemplate.compile(outer).expand(args)
+                expected, _ = AliasTemplate.compile(inner).expand(command[1:])
+                self.assertEqual(composed.expand(args)[0], expected)
+
+        self.assertIsNone(
+            AliasTemplate.compile("b {} x").compose(AliasTemplate.compile("ls"))
+        )
+
+    def test_alias_chain(self) -> None:
+        """Test that a chain of aliases is run as a single alias."""
+        for title, artist in [("a", "x"), ("b", "y"), ("c", "x")]:
+            self.add_item(title=title, artist=artist)
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {
+                    "x-titles": "artist-titles x {}",
+                    "artist-titles": "titles artist:{0}",
+                    "titles": "ls -f $title",
+                },
+            }
+        )
+
+        with self.assertFiresEvent("alias_succeeded") as events:
+            output = self.run_with_output("x-titles", "title:c")
+        self.assertEqual(output, "c\n")
+        self.assertEqual(
+            [args["alias"] for name, args in events if name == "alias_succeeded"],
+            ["x-titles"],
+        )
+
+        config = self._setup_config(
+            {"from_path": False, "aliases": {"a": "b", "b": "c x", "c": "a {}"}}
+        )
+        for lazy in (False, True):
+            config["lazy"] = lazy
+            self._setup_config(config)
+            with self.assertRaisesRegex(
+                ConfigError, "alias a: alias cycle a -> b -> c -> a"
+            ):
+                self.run_with_output("a")
+
     def test_run_external_indirect(self) -> None:
         """Test alias run external command aliased to another alias."""
         self._setup_config()
@@ -241,6 +660,293 @@ class AliasPluginTest(BeetsTestCase):
         with self.assertRaisesRegex(UserError, "unknown command 'testcommand2'"):
             self.run_with_output("testcommand2")
 
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_from_path_cache(self) -> None:
+        """Test that unchanged PATH directories are served from the path cache."""
+        cache_path = Path(os.fsdecode(self.temp_dir)) / "cache" / "path_cache.json"
+        cache_path.parent.mkdir()
+        self._setup_config({"from_path": True, "path_cache": str(cache_path)})
+        self.run_with_output("alias")
+
+        with open(cache_path) as f:
+            cache = json.load(f)
+        entry = cache["dirs"][os.fsdecode(self.temp_dir)]
+        self.assertEqual(entry["commands"], ["beet-testcommand"])
+
+        entry["commands"].append("beet-cachedcommand")
+        with open(cache_path, "w") as f:
+            json.dump(cache, f)
+
+        alias_output = self.run_with_output("alias")
+        self.assertIn("cachedcommand: !beet-cachedcommand", alias_output)
+
+        alias_output = self.run_with_output("alias", "--rescan")
+        self.assertNotIn("cachedcommand", alias_output)
+        self.assertIn("testcommand: !beet-testcommand", alias_output)
+
+        alias_output = self.run_with_output("alias")
+        self.assertNotIn("cachedcommand", alias_output)
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_from_path_cache_invalidated(self) -> None:
+        """Test that a changed PATH directory is rescanned."""
+        self._setup_config({"from_path": True})
+        self.run_with_output("alias")
+
+        testcommand3 = Path(os.fsdecode(self.temp_dir)) / "beet-testcommand3"
+        with open(testcommand3, "w") as f:
+            f.write("#!/bin/sh\necho 'Hello, world from beet-testcommand3!'\n")
+        testcommand3.chmod(0o755)
+
+        alias_output = self.run_with_output("alias")
+        self.assertIn("testcommand3", alias_output)
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_from_path_cache_disabled(self) -> None:
+        """Test that the path cache is not written when disabled."""
+        self._setup_config({"from_path": True, "path_cache": None})
+
+        alias_output = self.run_with_output("alias")
+        self.assertIn("testcommand", alias_output)
+        cache_path = Path(os.fsdecode(self.temp_dir)) / "alias_path_cache.json"
+        self.assertFalse(cache_path.exists())
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_from_path_ignore_directories(self) -> None:
+        """Test that alias will ignore directories from PATH."""
+        self._setup_config({"from_path": True, "path_cache": None})
+        (Path(os.fsdecode(self.temp_dir)) / "beet-testdir").mkdir()
+
+        alias_output = self.run_with_output("alias")
+        self.assertNotIn("testdir", alias_output)
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_from_path_timeout(self) -> None:
+        """Test that a PATH directory which takes too long to scan is skipped."""
+        self._setup_config({"from_path": True, "path_cache": None, "path_timeout": 0.2})
+        slow_dir = os.fsdecode(self.temp_dir)
+        scan_path_dir = self.plugin.scan_path_dir
+
+        def slow_scan_path_dir(directory: str) -> List[str]:
+            if directory == slow_dir:
+                time.sleep(5)
+            return scan_path_dir(directory)  # type: ignore
+
+        with patch.object(self.plugin, "scan_path_dir", slow_scan_path_dir):
+            start = time.monotonic()
+            alias_output = self.run_with_output("alias")
+            self.assertLess(time.monotonic() - start, 4)
+
+        self.assertNotIn("testcommand", alias_output)
+
+    def test_lazy(self) -> None:
+        """Test that lazy aliases are only created when invoked."""
+        config = self._setup_config()
+        self.config["alias"]["lazy"] = True
+
+        commands = {c.name: c for c in self.plugin.commands()}
+        self.assertIsNone(commands["hello"]._subcommand)
+
+        output = self.run_with_output("alias").splitlines()
+        for alias, command in config["aliases"].items():
+            self.assertIn(f"{alias}: {command}", output)
+
+        output = self.run_with_output("help")
+        self.assertIn("config-paths", output)
+
+        output = self.run_with_output("hello", "world")
+        self.assertIn("Hello world, I'm a plugin", output)
+        output = self.run_with_output("config-paths-alias")
+        self.assertEqual(output, f"{self.config_path}\n")
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_lazy_from_path(self) -> None:
+        """Test lazy aliases for commands from PATH."""
+        self._setup_config({"from_path": True, "lazy": True})
+
+        output = self.run_with_output("testcommand")
+        self.assertEqual(output, "Hello, world from beet-testcommand!\n")
+
+    def test_commands_memoized(self) -> None:
+        """Test that alias commands are only built once per plugin load."""
+        self._setup_config()
+
+        with patch.object(
+            self.plugin, "build_commands", wraps=self.plugin.build_commands
+        ) as build_commands:
+            output = self.run_with_output("config-paths-alias")
+            self.assertEqual(output, f"{self.config_path}\n")
+            self.assertEqual(build_commands.call_count, 1)
+
+            self.assertIs(self.plugin.commands(), self.plugin.commands())
+            self.assertEqual(build_commands.call_count, 1)
+
+            send("pluginload")
+            self.plugin.commands()
+            self.assertEqual(build_commands.call_count, 2)
+
+    def _write_python_script(self, name: str, source: str) -> Path:
+        """Write an executable Python beet-* script to the temporary directory."""
+        script = Path(os.fsdecode(self.temp_dir)) / name
+        with open(script, "w") as f:
+            f.write(f"#!/usr/bin/env python3\n{source}")
+        script.chmod(0o755)
+        return script
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_from_path_python_inprocess(self) -> None:
+        """Test running a Python script from PATH in the beets process."""
+        script = self._write_python_script(
+            "beet-pyscript",
+            "import os, sys\n"
+            "print(beets_lib is LIB, beets_config['alias']['python_scripts'])\n"
+            "print(sys.argv, os.getpid() == PID)\n",
+        )
+        self._setup_config(
+            {"from_path": True, "path_cache": None, "python_scripts": "inprocess"}
+        )
+
+        with patch("builtins.LIB", self.lib, create=True), patch(
+            "builtins.PID", os.getpid(), create=True
+        ):
+            output = self.run_with_output("pyscript", "a b")
+        self.assertEqual(output, f"True inprocess\n[{str(script)!r}, 'a b'] True\n")
+        self.assertEqual(sys.argv, ["beet"])
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_from_path_python_inprocess_failed(self) -> None:
+        """Test a failing Python script from PATH run in the beets process."""
+        self._write_python_script("beet-pyfail", "import sys\nsys.exit(3)\n")
+        self._setup_config(
+            {"from_path": True, "path_cache": None, "python_scripts": "inprocess"}
+        )
+
+        with self.assertRaises(SystemExit) as exc, self.assertFiresEvent(
+            "alias_failed", alias="pyfail", exitcode=3
+        ):
+            self.run_with_output("pyfail")
+        self.assertEqual(exc.exception.code, 3)
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_from_path_duplicate(self) -> None:
+        """Test that a script in several PATH directories runs the first one."""
+        self._write_python_script("beet-dup", "print('first')\n")
+        second = Path(os.fsdecode(self.temp_dir)) / "second"
+        second.mkdir()
+        (second / "beet-dup").write_text("#!/usr/bin/env python3\nprint('second')\n")
+        (second / "beet-dup").chmod(0o755)
+
+        with patch.dict(os.environ, {"PATH": f"{os.environ['PATH']}:{second}"}):
+            for mode in ["subprocess", "inprocess"]:
+                self._setup_config(
+                    {"from_path": True, "path_cache": None, "python_scripts": mode}
+                )
+                self.assertEqual(self.run_with_output("dup"), "first\n", mode)
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_from_path_python_subprocess(self) -> None:
+        """Test that Python scripts from PATH are run as a child by default."""
+        self._write_python_script("beet-pyscript", "print('beets_lib' in globals())\n")
+        self._setup_config({"from_path": True, "path_cache": None})
+
+        output = self.run_with_output("pyscript")
+        self.assertEqual(output, "False\n")
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_from_path_python_forkserver(self) -> None:
+        """Test running a Python script from PATH in a forkserver child."""
+        self._write_python_script(
+            "beet-pyscript",
+            "import os, sys\n"
+            "print(sys.argv[1:], os.getpid() != int(os.environ['PARENT']))\n"
+            "print('stdin:', sys.stdin.readline().strip())\n"
+            "sys.exit(int(sys.argv[1]))\n",
+        )
+        self._setup_config(
+            {"from_path": True, "path_cache": None, "python_scripts": "forkserver"}
+        )
+
+        input_path = Path(os.fsdecode(self.temp_dir)) / "input.txt"
+        input_path.write_text("hello\n")
+        output_path = Path(os.fsdecode(self.temp_dir)) / "output.txt"
+        with open(input_path) as stdin, open(output_path, "w") as output, patch.object(
+            sys, "stdin", stdin
+        ), patch.object(sys, "stdout", output), patch.dict(
+            os.environ, {"PARENT": str(os.getpid())}
+        ):
+            self.run_command("pyscript", "0")
+            with self.assertRaises(SystemExit) as exc:
+                self.run_command("pyscript", "2")
+        self.assertEqual(exc.exception.code, 2)
+        self.assertEqual(
+            output_path.read_text(),
+            "['0'] True\nstdin: hello\n['2'] True\nstdin: \n",
+        )
+
+    def test_forkserver_importable(self) -> None:
+        """Test that plugins only found through pluginpath are not preloaded."""
+        from beetsplug.alias import is_forkserver_importable
+
+        self._setup_config()
+        self.assertIn("beetsplug.testplugin", sys.modules)
+        for modname, expected in [
+            ("beets.library", True),
+            ("beetsplug.alias", True),
+            ("beetsplug.testplugin", False),
+        ]:
+            self.assertEqual(is_forkserver_importable(modname), expected, modname)
+
+    def test_alias_table_cache(self) -> None:
+        """Test that the alias table is cached while the config is unchanged."""
+        table_cache = Path(os.fsdecode(self.temp_dir)) / "cache" / "table.cache"
+        self._setup_config({"from_path": False, "table_cache": str(table_cache)})
+        self.config_path.write_text(
+            "aliases:\n"
+            "  greet: '!echo hello'\n"
+            "  greet-mapping:\n"
+            "    command: '!echo {0}'\n"
+            "    help: Greet someone\n"
+        )
+        self.config.set_file(str(self.config_path))
+
+        self.assertEqual(self.run_with_output("greet"), "hello\n")
+        self.assertTrue(table_cache.exists())
+
+        with patch("beetsplug.alias.compile_alias_table") as compile_alias_table:
+            send("pluginload")
+            self.assertEqual(self.run_with_output("greet-mapping", "you"), "you\n")
+        compile_alias_table.assert_not_called()
+
+        self.config_path.write_text("aliases:\n  greet: '!echo hello again'\n")
+        self.config.reload()
+        send("pluginload")
+        self.assertEqual(self.run_with_output("greet"), "hello again\n")
+
+        # Aliases set other than by a file are never cached
+        self.config["aliases"] = {"greet-memory": "!echo memory"}
+        with patch.object(self.plugin, "read_alias_table") as read_alias_table:
+            send("pluginload")
+            self.assertEqual(self.run_with_output("greet-memory"), "memory\n")
+        read_alias_table.assert_not_called()
+
+    def test_config_invalid_aliases(self) -> None:
+        """Test that every invalid alias is reported at once."""
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {"number": 1, "no-command": {"help": "?"}, "ok": "ls"},
+            }
+        )
+        with self.assertRaises(ConfigError) as exc:
+            self.run_with_output("ok")
+        self.assertEqual(
+            str(exc.exception).splitlines(),
+            [
+                "alias.aliases.number must be a string or single-element mapping",
+                "alias.aliases.no-command.command not found",
+            ],
+        )
+
     def test_duplicate_alias(self) -> None:
         """Test alias with duplicate name."""
         self._setup_config({"from_path": False, "aliases": {"hello": "echo"}})
@@ -302,6 +1008,36 @@ class AliasPluginTest(BeetsTestCase):
         with self.assertRaisesRegex(UserError, "unknown command 'missing'"):
             self.run_with_output("unknown")
 
+        # Other commands still work, so that the config can be fixed
+        self.assertIn("beets version", self.run_with_output("version"))
+        self.assertIn("unknown: missing", self.run_with_output("alias"))
+
+    def test_alias_invalid_on_load(self) -> None:
+        """Test that aliases invalid when loaded fail, but only themselves."""
+        aliases = {
+            "quoting": "!echo 'a",
+            "each": {"command": "!echo $title", "each": "song"},
+            "jobs": {"command": "!echo $title", "each": "item", "jobs": "many"},
+            "feed": {"command": "!cat", "feed": "items"},
+            "libraries": {"command": "ls", "libraries": []},
+            "cache": {"command": "ls", "cache": "sometimes"},
+            "pipeline": "ls | | !cat",
+        }
+        self._setup_config({"from_path": False, "aliases": aliases})
+        self.assertIn("beets version", self.run_with_output("version"))
+        self.assertIn("quoting: !echo 'a", self.run_with_output("alias"))
+        for name, message in [
+            ("quoting", "No closing quotation"),
+            ("each", "each must be item or album"),
+            ("jobs", "invalid literal"),
+            ("feed", "feed must be a mapping"),
+            ("libraries", "libraries must be a list of paths"),
+            ("cache", "cache must be yes or no"),
+            ("pipeline", "empty pipeline stage"),
+        ]:
+            with self.assertRaisesRegex(ConfigError, f"alias {name}: {message}"):
+                self.run_with_output(name)
+
     def test_alias_external_failed(self) -> None:
         """Test alias run external command which fails."""
         self._setup_config({"from_path": False, "aliases": {"fail": "!false"}})
@@ -311,11 +1047,578 @@ class AliasPluginTest(BeetsTestCase):
 
     def test_alias_internal_failed(self) -> None:
         """Test alias run internal command which fails."""
-        self._setup_config({"from_path": False, "aliases": {"fail": "config -x"}})
+        self._setup_config({"from_path": False, "aliases": {"fail": "config {}"}})
         with self.assertRaises(SystemExit) as exc:
-            self.run_with_output("fail")
+            self.run_with_output("fail", "-x")
             self.assertEqual(exc.exception.code, 2)
 
+    def test_alias_internal_invalid_options(self) -> None:
+        """Test that an alias with invalid options fails, but only itself."""
+        self._setup_config({"from_path": False, "aliases": {"fail": "config -x"}})
+        self.assertIn("beets version", self.run_with_output("version"))
+        with self.assertRaisesRegex(ConfigError, "alias fail: no such option: -x"):
+            self.run_with_output("fail")
+
+    def test_alias_internal_fixed_options(self) -> None:
+        """Test that the fixed options of an internal alias are parsed once."""
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {
+                    "config-paths": "config -p",
+                    "config-defaults": "config {} -d",
+                    "list-format": "ls -f '$title' {}",
+                },
+            }
+        )
+        commands = {c.name: c for c in self.plugin.commands()}
+
+        values, args, nfixed = commands["config-paths"].fixed
+        self.assertTrue(values.paths)
+        self.assertEqual((args, nfixed), ([], 1))
+        self.assertIsNone(commands["config-defaults"].fixed)
+        self.assertIsNone(commands["list-format"].fixed)
+
+        output = self.run_with_output("config-paths")
+        self.assertEqual(output, f"{self.config_path}\n")
+        output = self.run_with_output("config-paths", "-d")
+        self.assertIn("config_default.yaml", output)
+        self.assertFalse(values.defaults)
+
+    def _run_alias_subcommand(self, *args: str, stdin: str = "") -> List[str]:
+        """Run a `beet alias` subcommand, returning its stdout and stderr."""
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with patch.object(sys, "stdout", stdout), patch.object(
+            sys, "stderr", stderr
+        ), patch.object(sys, "stdin", io.StringIO(stdin)):
+            try:
+                self.run_command("alias", *args)
+            finally:
+                self.output = [stdout.getvalue(), stderr.getvalue()]
+        return self.output
+
+    def test_alias_batch(self) -> None:
+        """Test running commands read from a batch file."""
+        config = self._setup_config()
+        config["aliases"]["fail"] = "!false"
+        config["aliases"]["missing"] = "!no-such-command-xyz"
+        batch = Path(os.fsdecode(self.temp_dir)) / "batch.txt"
+        batch.write_text(
+            'hello world\n["hello", "big world"]\n# comment\n\nfail\nversion-alias\n'
+            "missing\nbye\n"
+        )
+
+        with self.assertRaisesRegex(UserError, "2 of 6 batch commands failed"):
+            self._run_alias_subcommand("batch", "--keep-going", str(batch))
+        stdout, stderr = self.output
+        self.assertTrue(
+            stdout.startswith(
+                "Hello world, I'm a plugin\nHello big world, I'm a plugin\n"
+            )
+        )
+        self.assertIn("beets version", stdout)
+        self.assertRegex(stderr, r"batch:1: exit 0 in [\d.]+s: hello world\n")
+        self.assertRegex(stderr, r"batch:2: exit 0 in [\d.]+s: hello 'big world'\n")
+        self.assertRegex(stderr, r"batch:5: exit 1 in [\d.]+s: fail\n")
+        self.assertRegex(stderr, r"batch:6: exit 0 in [\d.]+s: version-alias\n")
+        self.assertIn("error: [Errno 2] No such file or directory", stderr)
+        self.assertRegex(stderr, r"batch:7: exit 1 in [\d.]+s: missing\n")
+        self.assertTrue(stdout.endswith("Goodbye!\n"))
+
+    def test_alias_batch_fail_fast(self) -> None:
+        """Test that a batch read from stdin stops at the first failure."""
+        config = self._setup_config()
+        config["aliases"]["fail"] = "!false"
+
+        with self.assertRaisesRegex(UserError, "1 of 2 batch commands failed"):
+            self._run_alias_subcommand("batch", stdin="bye\nfail\nmissing\n")
+        stdout, stderr = self.output
+        self.assertEqual(stdout, "Goodbye!\n")
+        self.assertNotIn("batch:3", stderr)
+
+        stdout, stderr = self._run_alias_subcommand(
+            "batch", stdin="bye\nconfig-paths\n"
+        )
+        self.assertEqual(stdout, f"Goodbye!\n{self.config_path}\n")
+        self.assertIn("batch:2: exit 0", stderr)
+
+        stdin = io.StringIO("bye\n")
+        with patch.object(sys, "stdin", stdin), patch.object(
+            sys, "stdout", io.StringIO()
+        ):
+            self.run_command("alias", "batch", "-")
+        self.assertFalse(stdin.closed)
+
+    def test_alias_batch_exec(self) -> None:
+        """Test that exec aliases are run as a child in a batch."""
+        config = self._setup_config()
+        config["aliases"]["ex"] = {"command": "!echo exec", "exec": True}
+
+        output_path = Path(os.fsdecode(self.temp_dir)) / "output.txt"
+        with open(output_path, "w") as output, patch("os.execvp") as execvp:
+            with patch.object(sys, "stdout", output), patch.object(
+                sys, "stderr", output
+            ), patch.object(sys, "stdin", io.StringIO("hello a\nex\nhello b\n")):
+                self.run_command("alias", "batch")
+        execvp.assert_not_called()
+        output = [
+            line
+            for line in output_path.read_text().splitlines()
+            if not line.startswith("batch:")
+        ]
+        self.assertEqual(
+            output, ["Hello a, I'm a plugin", "exec", "Hello b, I'm a plugin"]
+        )
+
+    def test_alias_batch_format(self) -> None:
+        """Test that a format option applies to its own batch command only."""
+        self._setup_config()
+        self.add_item(title="t", artist="a", album="b")
+
+        stdout, _ = self._run_alias_subcommand(
+            "batch", stdin="ls -f '$title'\nls\nls -p\nls\n"
+        )
+        self.assertEqual(
+            stdout.splitlines(),
+            ["t", "a - b - t", os.fsdecode(self.lib.items().get().path), "a - b - t"],
+        )
+
+    def test_alias_run_parallel(self) -> None:
+        """Test running several commands at once, with their output grouped."""
+        config = self._setup_config()
+        ready = Path(os.fsdecode(self.temp_dir)) / "ready"
+        # slow-one waits for slow-two, so both only succeed when run at once
+        config["aliases"].update(
+            {
+                "slow-one": "!sh -c 'echo one; i=0; "
+                f'while [ ! -e "{ready}" ] && [ $i -lt 100 ]; do '
+                "sleep 0.1; i=$((i+1)); done; "
+                f'[ -e "{ready}" ] && echo one again\'',
+                "slow-two": f"!sh -c 'touch \"{ready}\"; echo two'",
+                "fail": "!false",
+            }
+        )
+
+        start = time.monotonic()
+        stdout, stderr = self._run_alias_subcommand(
+            "run-parallel", "slow-one", "slow-two", "config-paths", "hello 'big world'"
+        )
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(
+            stdout,
+            f"one\none again\ntwo\n{self.config_path}\nHello big world, I'm a plugin\n",
+        )
+        self.assertEqual(
+            re.findall(r"^run-parallel: exit (\d+) in [\d.]+s: (.*)$", stderr, re.M),
+            [
+                ("0", "slow-one"),
+                ("0", "slow-two"),
+                ("0", "config-paths"),
+                ("0", "hello 'big world'"),
+            ],
+        )
+
+        with self.assertRaises(SystemExit) as exc:
+            self._run_alias_subcommand("run-parallel", "-j", "1", "bye", "fail")
+        self.assertEqual(exc.exception.code, 1)
+        self.assertEqual(self.output[0], "Goodbye!\n")
+        self.assertIn("run-parallel: exit 1 in", self.output[1])
+
+    def _run_client(self, socket_path: Path, *args: str) -> Any:
+        """Run the alias client, returning the completed process."""
+        return subprocess.run(  # noqa: S603
+            [
+                sys.executable,
+                "-I",
+                str(tests_path.parent / "src" / "beetsplug" / "alias_client.py"),
+                "--no-fallback",
+                "--socket",
+                str(socket_path),
+                *args,
+            ],
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_alias_serve(self) -> None:
+        """Test running commands from the alias client on the alias server."""
+        config = self._setup_config()
+        config.update({"from_path": True, "path_cache": None})
+        config["aliases"]["fail"] = "!false"
+        socket_path = Path(os.fsdecode(self.temp_dir)) / "alias.sock"
+
+        server = threading.Thread(
+            target=self.run_command,
+            args=("alias", "serve", "--socket", str(socket_path)),
+        )
+        server.start()
+        try:
+            while self.plugin.server is None:
+                time.sleep(0.01)
+
+            client = self._run_client(socket_path, "hello", "big world")
+            self.assertEqual(client.stdout, "Hello big world, I'm a plugin\n")
+            self.assertEqual(client.returncode, 0)
+
+            client = self._run_client(socket_path, "fail")
+            self.assertEqual(client.returncode, 1)
+
+            client = self._run_client(socket_path, "missing")
+            self.assertEqual(client.stderr, "error: unknown command 'missing'\n")
+            self.assertEqual(client.returncode, 1)
+
+            client = self._run_client(socket_path, "config-paths")
+            self.assertEqual(client.stdout, f"{self.config_path}\n")
+
+            newcommand = Path(os.fsdecode(self.temp_dir)) / "beet-newcommand"
+            newcommand.write_text("#!/bin/sh\necho 'Hello from beet-newcommand'\n")
+            newcommand.chmod(0o755)
+            client = self._run_client(socket_path, "newcommand")
+            self.assertEqual(client.stdout, "Hello from beet-newcommand\n")
+        finally:
+            if self.plugin.server is not None:
+                self.plugin.server.shutdown()
+            server.join()
+        self.assertFalse(socket_path.exists())
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_alias_serve_format(self) -> None:
+        """Test that a client's format option does not leak to later clients."""
+        from beets.library import Library
+
+        self._setup_config()
+        lib = Library(self._create_library("served.db", "t"))
+        socket_path = Path(os.fsdecode(self.temp_dir)) / "alias.sock"
+        server = threading.Thread(
+            target=self.run_command,
+            args=("alias", "serve", "--socket", str(socket_path)),
+            kwargs={"lib": lib},
+        )
+        server.start()
+        try:
+            while self.plugin.server is None:
+                time.sleep(0.01)
+
+            client = self._run_client(socket_path, "ls", "-f", "$title")
+            self.assertEqual(client.stdout, "t\n")
+            client = self._run_client(socket_path, "ls")
+            self.assertEqual(client.stdout, "served.db -  - t\n")
+        finally:
+            if self.plugin.server is not None:
+                self.plugin.server.shutdown()
+            server.join()
+            lib._close()
+
+    def test_run_invocation_readonly_format(self) -> None:
+        """Test that a readonly command's format option does not leak."""
+        config = self._setup_config()
+        config["aliases"]["titles"] = {"command": "ls -f $title", "readonly": True}
+        config["aliases"]["rls"] = {"command": "ls", "readonly": True}
+        self.add_item(title="t", artist="a", album="b")
+        self.run_with_output("alias")
+        write_lock = threading.Lock()
+
+        for argv, expected in [
+            (["titles"], "t\n"),
+            (["ls"], "a - b - t\n"),
+            (["rls", "-f", "$artist"], "a\n"),
+            (["ls"], "a - b - t\n"),
+        ]:
+            output = io.StringIO()
+            with patch.object(sys, "stdout", output):
+                status = self.plugin.run_invocation(self.lib, argv, write_lock)
+            self.assertEqual((status, output.getvalue()), (0, expected))
+
+    def test_restoring_config_threads(self) -> None:
+        """Test that undoing one thread's config changes keeps another's."""
+        from beetsplug.alias import restoring_config
+
+        self._setup_config()
+        started, finish = threading.Event(), threading.Event()
+        seen = []
+
+        def run() -> None:
+            with restoring_config():
+                self.config["format_item"].set("$title")
+                started.set()
+                finish.wait(10)
+                seen.append(self.config["format_item"].get())
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        started.wait(10)
+        with restoring_config():
+            self.config["format_album"].set("$album")
+        finish.set()
+        thread.join()
+
+        self.assertEqual(seen, ["$title"])
+        self.assertNotEqual(self.config["format_item"].get(), "$title")
+        self.assertNotEqual(self.config["format_album"].get(), "$album")
+
+    def test_run_invocation_readonly(self) -> None:
+        """Test which commands run without the write lock."""
+        config = self._setup_config()
+        config["aliases"]["config-paths-readonly"] = {
+            "command": "config -p",
+            "readonly": True,
+        }
+        config["aliases"]["bye-write"] = {
+            "command": '!echo "Goodbye!"',
+            "readonly": False,
+        }
+        config["aliases"]["bye-piped"] = '!echo "Goodbye!" | !cat'
+        config["aliases"]["ls-piped"] = "ls | !cat"
+        self.run_with_output("alias")
+        write_lock = threading.Lock()
+
+        with write_lock:
+            for argv, expected in [
+                (["config-paths-readonly"], f"{self.config_path}\n"),
+                (["bye"], "Goodbye!\n"),
+                (["bye-piped"], "Goodbye!\n"),
+            ]:
+                output = io.StringIO()
+                with patch.object(sys, "stdout", output):
+                    status = self.plugin.run_invocation(self.lib, argv, write_lock)
+                self.assertEqual((status, output.getvalue()), (0, expected))
+
+            blocked = [
+                threading.Thread(
+                    target=self.plugin.run_invocation,
+                    args=(self.lib, [name], write_lock),
+                    daemon=True,
+                )
+                for name in ["config-paths", "bye-write", "ls-piped"]
+            ]
+            for thread in blocked:
+                thread.start()
+                thread.join(0.2)
+                self.assertTrue(thread.is_alive())
+        for thread in blocked:
+            thread.join()
+
+    def test_cron_expression(self) -> None:
+        """Test finding the next time matching a cron expression."""
+        from beetsplug.alias import CronExpression
+
+        for expression, after, expected in [
+            ("*/15 * * * *", datetime(2024, 1, 1, 10, 7), datetime(2024, 1, 1, 10, 15)),
+            ("0 3 * * *", datetime(2024, 1, 1, 3, 0), datetime(2024, 1, 2, 3, 0)),
+            ("0 0 1 * 1", datetime(2024, 1, 2, 12, 0), datetime(2024, 1, 8, 0, 0)),
+            ("0 0 * * 7", datetime(2024, 1, 2, 12, 0), datetime(2024, 1, 7, 0, 0)),
+            ("5-10/5 1,2 * 3 *", datetime(2024, 1, 1), datetime(2024, 3, 1, 1, 5)),
+            ("30 4 29 2 *", datetime(2024, 3, 1), datetime(2028, 2, 29, 4, 30)),
+        ]:
+            self.assertEqual(CronExpression(expression).next_after(after), expected)
+
+        for expression in ["* * * *", "61 * * * *", "a * * * *", "*/0 * * * *"]:
+            with self.assertRaises(ValueError):
+                CronExpression(expression)
+
+    def _run_scheduler(self, duration: float) -> Path:
+        """Run the scheduler for a while, returning the history file path."""
+        history = Path(os.fsdecode(self.temp_dir)) / "history.jsonl"
+        self.config["alias"]["schedule_history"] = str(history)
+        scheduler = threading.Thread(
+            target=self.run_command, args=("alias", "scheduler")
+        )
+        scheduler.start()
+        try:
+            time.sleep(duration)
+        finally:
+            while self.plugin.scheduler is None:
+                time.sleep(0.01)
+            self.plugin.scheduler.stop()
+            scheduler.join()
+        return history
+
+    def test_alias_scheduler(self) -> None:
+        """Test running aliases with a schedule."""
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {
+                    "tick": {"command": "!true", "schedule": {"interval": 0.05}},
+                    "nightly": {"command": "!true", "schedule": {"cron": "0 3 * * *"}},
+                    "unscheduled": "!true",
+                },
+            }
+        )
+        output = self.run_with_output("alias", "scheduler", "--list")
+        self.assertRegex(
+            output,
+            r"^tick: \d{4}-\d\d-\d\d \d\d:\d\d\nnightly: \d{4}-\d\d-\d\d 03:00\n$",
+        )
+
+        history = self._run_scheduler(0.3)
+        runs = [json.loads(line) for line in history.read_text().splitlines()]
+        self.assertGreaterEqual(len(runs), 2)
+        self.assertEqual({run["alias"] for run in runs}, {"tick"})
+        self.assertEqual({run["exit"] for run in runs}, {0})
+
+    def test_alias_scheduler_overlap(self) -> None:
+        """Test that a scheduled alias is not run while it is still running."""
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {
+                    "slow": {"command": "!sleep 1", "schedule": {"interval": 0.05}},
+                },
+            }
+        )
+        history = self._run_scheduler(0.5)
+        runs = [json.loads(line) for line in history.read_text().splitlines()]
+        self.assertEqual(len(runs), 1)
+        self.assertGreaterEqual(runs[0]["duration"], 1)
+
+    def test_alias_scheduler_exec(self) -> None:
+        """Test that a scheduled exec alias is run as a child."""
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {
+                    "tick": {
+                        "command": "!echo tick",
+                        "exec": True,
+                        "schedule": {"interval": 0.05},
+                    },
+                },
+            }
+        )
+        output_path = Path(os.fsdecode(self.temp_dir)) / "output.txt"
+        with open(output_path, "w") as output, patch("os.execvp") as execvp:
+            with patch.object(sys, "stdout", output), patch.object(
+                sys, "stderr", output
+            ):
+                history = self._run_scheduler(0.3)
+        execvp.assert_not_called()
+        runs = [json.loads(line) for line in history.read_text().splitlines()]
+        self.assertGreaterEqual(len(runs), 2)
+        self.assertEqual(output_path.read_text().count("tick\n"), len(runs))
+
+    def test_config_invalid_schedule(self) -> None:
+        """Test that an invalid schedule is rejected."""
+        for schedule, message in [
+            ("hourly", "schedule must be a mapping"),
+            ({"jitter": 5}, "schedule must have one of interval or cron"),
+            ({"interval": -1}, "interval must be positive"),
+            ({"cron": "* * *"}, "must have 5 fields"),
+        ]:
+            self._setup_config(
+                {
+                    "from_path": False,
+                    "aliases": {"tick": {"command": "!true", "schedule": schedule}},
+                }
+            )
+            with self.assertRaisesRegex(ConfigError, f"alias tick: .*{message}"):
+                self.run_with_output("alias", "scheduler")
+
+    def _create_library(self, name: str, *titles: str) -> str:
+        """Create a library database holding items with the given titles."""
+        from beets.library import Item
+        from beets.library import Library
+
+        path = os.path.join(os.fsdecode(self.temp_dir), name)
+        lib = Library(path)
+        for title in titles:
+            lib.add(Item(title=title, artist=name, path=f"/music/{title}.mp3"))
+        lib._close()
+        return path
+
+    def test_alias_libraries(self) -> None:
+        """Test running an internal alias against several libraries."""
+        libraries = [
+            self._create_library("flac.db", "a", "c", "e"),
+            self._create_library("mp3.db", "b", "d"),
+        ]
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {
+                    "titles": {"command": "ls -f $title", "libraries": libraries},
+                    "artists": {"command": "ls -f $artist", "libraries": libraries},
+                    "missing": {"command": "ls", "libraries": ["missing.db"]},
+                },
+            }
+        )
+
+        output = self.run_with_output("titles")
+        self.assertEqual(sorted(output.splitlines()), ["a", "b", "c", "d", "e"])
+
+        output = self.run_with_output("titles", "title::^[b-d]")
+        self.assertEqual(sorted(output.splitlines()), ["b", "c", "d"])
+
+        output = self.run_with_output("artists")
+        self.assertEqual(sorted(output.splitlines()), ["flac.db"] * 3 + ["mp3.db"] * 2)
+
+        with self.assertRaises(SystemExit) as exc:
+            self.run_with_output("missing")
+        self.assertEqual(exc.exception.code, 1)
+
+    def test_alias_cache(self) -> None:
+        """Test replaying the cached output of an internal alias."""
+        from beets.library import Item
+        from beets.library import Library
+
+        lib = Library(self._create_library("cached.db", "a", "b"))
+        cache_dir = Path(os.fsdecode(self.temp_dir)) / "cache"
+        self._setup_config(
+            {
+                "from_path": False,
+                "cache_dir": str(cache_dir),
+                "aliases": {"titles": {"command": "ls -f $title", "cache": True}},
+            }
+        )
+
+        def run(*args: str) -> str:
+            output = io.TextIOWrapper(io.BytesIO(), write_through=True)
+            with patch.object(sys, "stdout", output):
+                self.assertEqual(self.plugin.run_invocation(lib, ["titles", *args]), 0)
+            return output.buffer.getvalue().decode()
+
+        self.assertEqual(run(), "a\nb\n")
+        with patch("beets.ui.commands.list_items") as list_items:
+            self.assertEqual(run(), "a\nb\n")
+        list_items.assert_not_called()
+        self.assertEqual(run("title:b"), "b\n")
+        self.assertEqual(len(list(cache_dir.iterdir())), 2)
+
+        lib.add(Item(title="c", artist="cached.db", path="/music/c.mp3"))
+        self.assertEqual(run(), "a\nb\nc\n")
+
+        self.config["alias"]["cache_size"] = 4
+        self.assertEqual(run("title:c"), "c\n")
+        self.assertEqual([p.read_bytes() for p in cache_dir.iterdir()], [b"c\n"])
+        lib._close()
+
+        # The in-memory test library is never cached
+        self.add_item(title="d")
+        self.assertEqual(self.run_with_output("titles", "title:d"), "d\n")
+        self.assertEqual(len(list(cache_dir.iterdir())), 1)
+
+    def test_config_invalid_libraries(self) -> None:
+        """Test that invalid libraries and cache options are rejected."""
+        for options, message in [
+            ({"libraries": []}, "libraries must be a list of paths"),
+            ({"libraries": [1]}, "libraries must be a list of paths"),
+            ({"cache": "sometimes"}, "cache must be yes or no"),
+            (
+                {"libraries": "a.db", "cache": True},
+                "cache cannot be used with libraries",
+            ),
+        ]:
+            self._setup_config(
+                {
+                    "from_path": False,
+                    "aliases": {"shards": {"command": "ls", **options}},
+                }
+            )
+            with self.assertRaisesRegex(ConfigError, f"alias shards: {message}"):
+                self.run_with_output("shards")
+
     def test_alias_succeeded_event(self) -> None:
         """Test firing of alias_succeeded event."""
         self._setup_config(
@@ -346,6 +1649,45 @@ class AliasPluginTest(BeetsTestCase):
         ):
             self.run_with_output("fail")
 
+    @pytest.mark.skipif(sys.platform == "win32", reason="Skipping test on Windows")
+    def test_alias_report_database_changes(self) -> None:
+        """Test sending database_change events for reported changes."""
+        item = self.add_item(title="changed")
+        album = self.lib.add_album([self.add_item(title="other")])
+        self._setup_config(
+            {
+                "from_path": False,
+                "aliases": {
+                    "change": "!sh -c 'for c; do echo $c >> $BEETS_ALIAS_CHANGES; "
+                    "done; echo $BEETS_ALIAS_CHANGES; exit 8' sh",
+                },
+            }
+        )
+
+        output_path = Path(os.fsdecode(self.temp_dir)) / "output.txt"
+        with open(output_path, "w") as output, patch.object(
+            sys, "stdout", output
+        ), self.assertFiresEvent("database_change") as events:
+            status = self.plugin.run_invocation(
+                self.lib, ["change", f"item {item.id}", f"album {album.id}"]
+            )
+        self.assertEqual(status, 8)
+        models = [
+            (type(args["model"]), args["model"].id)
+            for name, args in events
+            if name == "database_change"
+        ]
+        self.assertEqual(models, [(type(album), album.id), (type(item), item.id)])
+        self.assertFalse(os.path.exists(output_path.read_text().strip()))
+
+        with self.assertFiresEvent("database_change") as events:
+            self.plugin.run_invocation(
+                self.lib, ["change", f"item {item.id}", "item 1000"]
+            )
+        models = [args["model"] for name, args in events if name == "database_change"]
+        self.assertEqual(models[0].id, item.id)
+        self.assertEqual(models[1:], [None])
+
     def test_alias_to_command_which_exits_explicitly(self) -> None:
         """Test alias to a command which explicitly exits successfully ."""
         self._setup_config({"from_path": False, "aliases": {"testalias": "testexit"}})